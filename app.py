@@ -1,25 +1,39 @@
 import numpy as np
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, make_response, g, abort
 from flask_login import LoginManager, UserMixin, login_user, current_user, logout_user
 from forms import LoginForm, UploadForm
 from local_settings import SECRET_KEY
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
 from sqlalchemy.sql import text
-from flask_admin import Admin, expose, AdminIndexView
+from flask_admin import Admin, BaseView, expose, AdminIndexView
 from flask_admin.contrib.sqla import ModelView
 from sqlalchemy.sql.functions import current_timestamp
-from sqlalchemy import event
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
 from pytz import timezone
 from dateutil import parser
-import pandas as pd
-import plotly.graph_objects as go
-import plotly
-import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import click
 import zipfile
 import scoring
+import jobs
+import metrics
+import validation
+import storage
+import events
 import json
 import hashlib
+import base64
+import binascii
+import uuid
+import socket
+import threading
+import time
 import os
 
 base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -29,18 +43,71 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 app.secret_key = SECRET_KEY
 app.config['MAX_CONTENT_LENGTH'] = 200 * 1024 * 1024
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{host}/{name}'.format(**{
-    'host': base_dir,
-    'name': 'db.sqlite3'
-})
+# 採点に使うワーカープロセス数 (None なら CPU コア数)
+app.config['SCORING_WORKERS'] = None
+# 同時に採点するジョブの数 (None なら SCORING_WORKERS と同じ)
+app.config['MAX_ACTIVE_JOBS'] = None
+# 採点の順番を待てるジョブの数 (超えた提出は 429 で断る，None なら無制限)
+app.config['MAX_WAITING_JOBS'] = 50
+# 同時に提出ファイルを検査するリクエストの数と，空きを待つ秒数
+app.config['MAX_VALIDATIONS'] = 4
+app.config['VALIDATION_WAIT'] = 5
+# ユーザごとの採点待ち・採点中のジョブの上限 (管理者は制限しない)
+app.config['USER_MAX_PENDING_JOBS'] = 2
+# ユーザごとの SUBMIT_RATE_WINDOW 秒間の提出回数の上限 (None なら制限しない)
+app.config['SUBMIT_RATE_LIMIT'] = 20
+app.config['SUBMIT_RATE_WINDOW'] = 3600
+# ユーザごとの提出回数の上限 (User.n_submit と採点待ちの数の合計，None なら制限しない)
+app.config['SUBMIT_QUOTA'] = None
+app.config['UPLOAD_DIR'] = os.path.join(base_dir, 'uploads')
+# 再採点のために提出ファイルを内容の sha256 ごとに保存する場所 (None なら保存しない)
+# ベンチマーク等で別の場所に保存する場合は環境変数で指定する
+app.config['ARCHIVE_DIR'] = os.environ.get(
+    'LEADERBOARD_ARCHIVE_DIR', os.path.join(base_dir, 'archive'))
+# scoring.get_score の採点方法 ('python' / 'numpy')
+app.config['SCORING_ENGINE'] = 'numpy'
+# ログイン中のユーザの情報を問い合わせずに使い回す秒数と件数
+app.config['USER_CACHE_TTL'] = 60
+app.config['USER_CACHE_SIZE'] = 1024
+# 提出時の検査で報告するエラーの最大件数
+app.config['VALIDATION_MAX_ERRORS'] = 20
+# 採点対象にない page_id を含む提出もエラーにする (採点対象が公開されている場合)
+app.config['VALIDATE_TARGET_PAGES'] = False
+# 採点時にオフセットがページのテキストと合っているかも確認する
+# (data/settings.json の plain_dict, html_dict に {ファイル名: ページのディレクトリ} を指定する)
+app.config['CHECK_OFFSETS'] = False
+# 採点の段階ごとの秒数を計測する (少し遅くなる)
+app.config['SCORING_TIMINGS'] = True
+# /metrics を管理者以外が読む時のトークン (Authorization: Bearer <token>)
+app.config['METRICS_TOKEN'] = os.environ.get('LEADERBOARD_METRICS_TOKEN')
+# /api/events (Server-Sent Events) に同時に接続できるプロセスごとの数
+# 接続ごとにサーバのスレッドを1つ使い続けるので，ワーカーのスレッド数より十分小さくする
+# (同期ワーカーでは接続の数だけ他のリクエストを処理できなくなる)
+app.config['MAX_EVENT_SUBSCRIBERS'] = 20
+# 他のプロセスによる Score の変更を確かめる間隔 (秒)
+app.config['SCORE_STATE_INTERVAL'] = 1.0
+# リクエスト・採点の計測値をjsonのログとしても出力する
+app.config['METRICS_LOG'] = False
+# ベンチマーク等で別のDB・設定ファイルを使う場合は環境変数で指定する
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+    'LEADERBOARD_DATABASE_URI',
+    'sqlite:///{host}/{name}'.format(**{
+        'host': base_dir,
+        'name': 'db.sqlite3'
+    })
+)
+if storage.is_sqlite_file(app.config['SQLALCHEMY_DATABASE_URI']):
+    # 複数のスレッドで接続を使い回し，WAL で読み込みが書き込みを待たないようにする
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = storage.sqlite_engine_options()
 #app.config['FLASK_ADMIN_SWATCH'] = 'United'
 db = SQLAlchemy(app)
+event.listen(Engine, 'connect', storage.set_sqlite_pragmas)
 migrate = Migrate(app, db)
 
 
 def utc_to_jst(timestring):
     date = parser.parse(
-        timestring,
+        str(timestring),
         default=parser.parse('00:00Z')
     ).astimezone(timezone("Asia/Tokyo"))
     return date.strftime("%Y-%m-%d %H:%M")
@@ -48,6 +115,79 @@ def utc_to_jst(timestring):
 
 app.jinja_env.filters['utc_to_jst'] = utc_to_jst
 
+settings_path = os.environ.get(
+    'LEADERBOARD_SETTINGS', os.path.join(base_dir, 'data', 'settings.json'))
+_settings_cache = {}
+
+
+def load_settings():
+    # data/settings.json は更新時刻が変わった時だけ読み直す
+    mtime = os.stat(settings_path).st_mtime_ns
+    if _settings_cache.get('mtime') != mtime:
+        with open(settings_path, 'r') as f:
+            settings = json.load(f)
+        # 採点対象の page_id は集合にしておく (csv のパスは base_dir からの相対パス)
+        settings['target_dict'] = {
+            basename: scoring.normalize_target(
+                os.path.join(base_dir, target)
+                if isinstance(target, str) and not target.startswith('[') else target)
+            for basename, target in settings['target_dict'].items()
+        }
+        _settings_cache['settings'] = settings
+        _settings_cache['mtime'] = mtime
+    return _settings_cache['settings']
+
+
+def preload_annotations():
+    # 提出時の検査に使う ENE を読んでおく (採点はワーカープロセスで行うので正答データ全体は読まない)
+    settings = load_settings()
+    for annotation_path in settings['annotation_dict'].values():
+        scoring.load_ene(os.path.join(base_dir, annotation_path))
+
+
+_gold_version_cache = {}
+
+
+def gold_version(basename):
+    # 正答データの内容・採点対象・属性名の置換表から作る版 (採点結果のキャッシュのキーに使う)
+    settings = load_settings()
+    annotation_path = os.path.join(base_dir, settings['annotation_dict'][basename])
+    if os.path.isdir(annotation_path):
+        files = [os.path.join(annotation_path, name)
+                 for name in sorted(os.listdir(annotation_path))]
+    else:
+        files = [annotation_path]
+    key = (
+        _settings_cache['mtime'],
+        tuple((os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in files)
+    )
+    cached = _gold_version_cache.get(basename)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    digest = hashlib.sha1()
+    for path in files:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    digest.update(json.dumps(
+        sorted(settings['target_dict'][basename])).encode('utf-8'))
+    digest.update(json.dumps(
+        scoring.REPLACE_LIST, sort_keys=True).encode('utf-8'))
+    version = digest.hexdigest()
+    _gold_version_cache[basename] = (key, version)
+    return version
+
+
+def combined_gold_version(versions=None):
+    # 全カテゴリの gold_version をまとめた版 (Score.gold_version)
+    # versions を渡した場合はその版をまとめる (採点を始めた時の版など)
+    if versions is None:
+        versions = {basename: gold_version(basename) for basename in CATEGORY_FILES}
+    digest = hashlib.sha1()
+    for basename in sorted(CATEGORY_FILES):
+        digest.update('{}:{}\n'.format(basename, versions[basename]).encode('utf-8'))
+    return digest.hexdigest()
+
 
 class User(UserMixin, db.Model):
     __tablename__ = "users"
@@ -75,6 +215,11 @@ class User(UserMixin, db.Model):
 
 class Score(db.Model):
     __tablename__ = "scores"
+    __table_args__ = (
+        db.Index('ix_scores_user_primary_key_created_at',
+                 'user_primary_key', 'created_at'),
+        db.Index('ix_scores_created_at_id', 'created_at', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.TIMESTAMP, server_default=current_timestamp())
     user_primary_key = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -85,11 +230,16 @@ class Score(db.Model):
     # Compound = db.Column(db.Float, nullable=False)
     # Airport = db.Column(db.Float, nullable=False)
     Overall = db.Column(db.Float, nullable=False)
+    # 採点に使った正答データの版 (combined_gold_version)
+    gold_version = db.Column(db.String(40), nullable=True)
+    # 再採点で置き換えられた場合は新しい Score の id
+    superseded_by = db.Column(db.Integer, db.ForeignKey('scores.id'), nullable=True)
     user = db.relationship("User")
 
     def __init__(self, result_dict):
         self.user_primary_key = result_dict['user_primary_key']
         self.comment = result_dict['comment']
+        self.gold_version = result_dict.get('gold_version')
         # self.Person = result_dict['Person.json']
         self.Company = result_dict['Company.json']
         self.City = result_dict['City.json']
@@ -98,7 +248,128 @@ class Score(db.Model):
         self.Overall = result_dict['overall']
 
 
-db.create_all()
+class Leaderboard(db.Model):
+    # ユーザごとの最新の提出 (Score の追加と同じトランザクションで更新する)
+    __tablename__ = "leaderboard"
+    user_primary_key = db.Column(
+        db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    score_id = db.Column(db.Integer, db.ForeignKey('scores.id'), nullable=False)
+    Overall = db.Column(db.Float, nullable=False, index=True)
+
+
+def refresh_leaderboard(user_primary_key):
+    latest = db.session.query(Score).filter_by(
+        user_primary_key=user_primary_key, superseded_by=None
+    ).order_by(Score.created_at.desc(), Score.id.desc()).first()
+    entry = db.session.query(Leaderboard).get(user_primary_key)
+    if latest is None:
+        if entry is not None:
+            db.session.delete(entry)
+        return
+    if entry is None:
+        entry = Leaderboard(user_primary_key=user_primary_key)
+        db.session.add(entry)
+    entry.score_id = latest.id
+    entry.Overall = latest.Overall
+
+
+def add_score(result):
+    score_record = Score(result)
+    db.session.add(score_record)
+    db.session.flush()
+    refresh_leaderboard(score_record.user_primary_key)
+    return score_record
+
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+    id = db.Column(db.String(32), primary_key=True)
+    created_at = db.Column(db.TIMESTAMP, server_default=current_timestamp())
+    finished_at = db.Column(db.TIMESTAMP, nullable=True)
+    user_primary_key = db.Column(db.Integer, db.ForeignKey('users.id'))
+    comment = db.Column(db.String(256), unique=False, nullable=True)
+    path = db.Column(db.String(512), nullable=False)
+    # queued / running / done / failed
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    message = db.Column(db.String(256), nullable=True)
+    score_id = db.Column(db.Integer, db.ForeignKey('scores.id'), nullable=True)
+    # 採点するプロセス (ホスト名:pid)
+    owner = db.Column(db.String(128), nullable=True)
+    user = db.relationship("User")
+    score = db.relationship("Score")
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'message': self.message,
+            'comment': self.comment,
+            'created_at': str(self.created_at),
+            'finished_at': str(self.finished_at) if self.finished_at else None,
+            'score': None if self.score is None else {
+                'Company': self.score.Company,
+                'City': self.score.City,
+                'Overall': self.score.Overall,
+            },
+        }
+
+
+class ScoreCache(db.Model):
+    # (カテゴリ, 正答データの版, 提出ファイルの sha256) ごとの採点結果
+    __tablename__ = "score_cache"
+    __table_args__ = (
+        db.UniqueConstraint('category', 'gold_version', 'content_hash',
+                            name='uq_score_cache_key'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.TIMESTAMP, server_default=current_timestamp())
+    category = db.Column(db.String(64), nullable=False)
+    gold_version = db.Column(db.String(40), nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False)
+    f1 = db.Column(db.Float, nullable=False)
+    offset_type = db.Column(db.String(16), nullable=False)
+    # 属性ごとのスコア (json)
+    score = db.Column(db.Text, nullable=False)
+    # 属性ごとのTP,TPFP,TPFN (jobs.pack_counts)
+    counts = db.Column(db.LargeBinary, nullable=True)
+    # オフセットの確認結果 (json, 確認せずに採点した場合は None)
+    offset_errors = db.Column(db.Text, nullable=True)
+
+
+class ScoreFile(db.Model):
+    # 提出ごとのカテゴリファイルの sha256 (チーム間で同じファイルの提出を探すのに使う)
+    __tablename__ = "score_files"
+    id = db.Column(db.Integer, primary_key=True)
+    score_id = db.Column(db.Integer, db.ForeignKey('scores.id'), nullable=False)
+    category = db.Column(db.String(64), nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+    # 採点したオフセットの種類と属性ごとのTP,TPFP,TPFN (jobs.pack_counts)
+    offset_type = db.Column(db.String(16), nullable=True)
+    counts = db.Column(db.LargeBinary, nullable=True)
+    score = db.relationship("Score")
+
+
+class ScoreState(db.Model):
+    # プロセス間で共有する Score の状態
+    # 'epoch' は既存の Score や User が変更・削除されるたびに増える (flask rescore など別のプロセスの変更を知るのに使う)
+    __tablename__ = "score_state"
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+def create_tables():
+    # 空のDBだけ create_all で作り，マイグレーションは最新まで済んだことにする
+    # 既存のDBに足りないテーブル・列は flask db upgrade で作る
+    # (ここで先に作ると upgrade が失敗し，移行時のデータの埋め込みも行われない)
+    if inspect(db.engine).get_table_names():
+        return
+    db.create_all()
+    with db.engine.begin() as connection:
+        MigrationContext.configure(connection).stamp(
+            ScriptDirectory(os.path.join(base_dir, 'migrations')), 'heads')
+
+
+create_tables()
 
 
 @event.listens_for(User.password, 'set', retval=True)
@@ -108,10 +379,70 @@ def hash_user_password(target, value, oldvalue, initiator):
     return value
 
 
+# Score が commit されるたびに増える世代番号 (リーダーボードのキャッシュのキーに使う)
+# epoch は既存の Score や User が変更・削除された時だけ増える (追記で済まない場合)
+# 他のプロセスによる変更は sync_score_generation で反映する
+score_generation = {'value': 0, 'epoch': 0}
+
+
+def bump_score_epoch(connection):
+    # 同じトランザクションで score_state の epoch を増やす
+    connection.execute(text(
+        "insert or ignore into score_state (name, value) values ('epoch', 0)"))
+    connection.execute(text(
+        "update score_state set value = value + 1 where name = 'epoch'"))
+
+
+@event.listens_for(Session, 'after_flush')
+def mark_scores_changed(session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, (Score, Leaderboard, User)):
+            session.info['scores_changed'] = True
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Score, Leaderboard, User)):
+            session.info['scores_changed'] = True
+        if isinstance(obj, (Score, User)):
+            if not session.info.get('scores_rewritten'):
+                bump_score_epoch(session.connection())
+            session.info['scores_rewritten'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def bump_score_generation(session):
+    if session.info.pop('scores_rewritten', False):
+        score_generation['epoch'] += 1
+    if session.info.pop('scores_changed', False):
+        score_generation['value'] += 1
+        # 次のリクエストで DB の状態 (ETag に使う) を読み直す
+        _score_state['stale'] = True
+
+
+@event.listens_for(Session, 'after_rollback')
+def clear_scores_changed(session):
+    session.info.pop('scores_changed', None)
+    session.info.pop('scores_rewritten', None)
+
+
 class ScoreView(ModelView):
     def is_accessible(self):
         return current_user.is_admin
 
+    def after_model_change(self, form, model, is_created):
+        refresh_leaderboard(model.user_primary_key)
+        db.session.commit()
+
+    def after_model_delete(self, model):
+        refresh_leaderboard(model.user_primary_key)
+        db.session.commit()
+
+
+class JobView(ModelView):
+    can_create = False
+    column_default_sort = ('created_at', True)
+
+    def is_accessible(self):
+        return current_user.is_admin
+
 
 class UserView(ModelView):
     column_exclude_list = ['scores']
@@ -119,6 +450,60 @@ class UserView(ModelView):
     def is_accessible(self):
         return current_user.is_admin
 
+    def after_model_change(self, form, model, is_created):
+        # user_id が変わった場合もあるので全て捨てる
+        user_cache.clear()
+
+    def after_model_delete(self, model):
+        user_cache.clear()
+
+
+class DuplicatesView(BaseView):
+    # 複数のユーザから同じ内容のファイルが提出されたものの一覧
+    @expose('/')
+    def index(self):
+        duplicates = db.session.execute(text(
+            """
+            SELECT score_files.category, score_files.content_hash,
+                users.print_name, s.id, s.created_at, s.comment
+            FROM score_files
+            INNER JOIN scores s ON s.id = score_files.score_id
+            INNER JOIN users ON users.id = s.user_primary_key
+            WHERE s.superseded_by IS NULL
+            AND (score_files.category, score_files.content_hash) IN (
+                SELECT f.category, f.content_hash
+                FROM score_files f
+                INNER JOIN scores ON scores.id = f.score_id
+                WHERE scores.superseded_by IS NULL
+                GROUP BY f.category, f.content_hash
+                HAVING COUNT(DISTINCT scores.user_primary_key) > 1
+            )
+            ORDER BY score_files.category, score_files.content_hash, s.created_at
+            """
+        )).fetchall()
+        return self.render('admin/duplicates.html', duplicates=duplicates)
+
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.is_admin
+
+
+class QueueView(BaseView):
+    # 採点キューの混み具合と採点待ち・採点中のジョブ
+    @expose('/')
+    def index(self):
+        pending_jobs = db.session.query(Job).filter(
+            Job.status.in_(['queued', 'running'])
+        ).order_by(Job.created_at).all()
+        return self.render(
+            'admin/queue.html', depth=scoring_queue.depth(),
+            max_active=scoring_queue.max_active,
+            max_waiting=scoring_queue.max_waiting,
+            validations=app.config['MAX_VALIDATIONS'],
+            pending_jobs=pending_jobs)
+
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.is_admin
+
 
 class MyAdminIndexView(AdminIndexView):
     @expose('/')
@@ -132,11 +517,118 @@ class MyAdminIndexView(AdminIndexView):
 admin = Admin(app, index_view=MyAdminIndexView(), template_mode='bootstrap3')
 admin.add_view(ScoreView(Score, db.session))
 admin.add_view(UserView(User, db.session))
+admin.add_view(JobView(Job, db.session))
+admin.add_view(DuplicatesView(name='Duplicates', endpoint='duplicates'))
+admin.add_view(QueueView(name='Queue', endpoint='queue'))
+
+scoring_queue = jobs.ScoringQueue(max_workers=app.config['SCORING_WORKERS'],
+                                  archive_dir=app.config['ARCHIVE_DIR'],
+                                  max_active=app.config['MAX_ACTIVE_JOBS'],
+                                  max_waiting=app.config['MAX_WAITING_JOBS'])
+# 提出ファイルの検査 (zip の展開と json の読み込み) を同時に行う数
+validation_slots = threading.BoundedSemaphore(app.config['MAX_VALIDATIONS'])
+metrics.registry.gauge(
+    'leaderboard_scoring_jobs_running', 'Number of scoring jobs being scored.',
+    lambda: scoring_queue.depth()['running'])
+metrics.registry.gauge(
+    'leaderboard_scoring_jobs_waiting', 'Number of scoring jobs waiting for a worker.',
+    lambda: scoring_queue.depth()['waiting'])
+
+
+def log_metrics(event_name, **fields):
+    if app.config['METRICS_LOG']:
+        app.logger.info(json.dumps(dict(fields, event=event_name), ensure_ascii=False))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_sql_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_sql_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    # 文の種類 (SELECT, INSERT, ...) ごとに集計する
+    metrics.sql_duration.observe(
+        elapsed, statement=statement.lstrip().split(None, 1)[0].upper())
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+# DB上の epoch と最大の Score の id (最後に確かめた時の値)
+# stale はこのプロセスが Score を commit した後 (間隔によらず読み直す)
+_score_state = {'checked': None, 'stale': False, 'epoch': None, 'max_id': None}
+
+
+@app.before_request
+def sync_score_generation():
+    # flask rescore や別のワーカープロセスが Score を書き換えた場合もキャッシュを作り直す
+    # (問い合わせは SCORE_STATE_INTERVAL 秒に1回まで)
+    checked = _score_state['checked']
+    if checked is not None and not _score_state['stale'] \
+            and time.monotonic() - checked < app.config['SCORE_STATE_INTERVAL']:
+        return
+    refresh_score_state()
+
+
+def refresh_score_state():
+    # DB の epoch と最大の Score の id を読み，変わっていれば世代番号を増やす
+    checked = _score_state['checked']
+    _score_state['checked'] = time.monotonic()
+    _score_state['stale'] = False
+    epoch, max_id = db.session.execute(text(
+        "select (select value from score_state where name = 'epoch'),"
+        " (select max(id) from scores)")).fetchone()
+    epoch = epoch or 0
+    if checked is not None:
+        if epoch != _score_state['epoch']:
+            score_generation['epoch'] += 1
+            score_generation['value'] += 1
+        elif max_id != _score_state['max_id']:
+            score_generation['value'] += 1
+    _score_state['epoch'] = epoch
+    _score_state['max_id'] = max_id
+
+
+def score_state_tag():
+    # リーダーボードの ETag に使う DB の状態 (プロセスの再起動やワーカーの違いで変わらない)
+    return '{}-{}'.format(_score_state['epoch'], _score_state['max_id'])
+
+
+@app.after_request
+def record_request_duration(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.request_duration.observe(
+            elapsed, route=route, method=request.method,
+            status=response.status_code)
+        log_metrics('request', route=route, method=request.method,
+                    status=response.status_code, duration=elapsed)
+    return response
+
+
+# user_id ごとのセッションから切り離した User (user_loader で使う)
+user_cache = storage.TTLCache(
+    max_size=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
 
 
 @login_manager.user_loader
 def user_loader(user_id):
-    return db.session.query(User).filter_by(user_id=user_id).first()
+    cached = user_cache.get(user_id)
+    if cached is None:
+        user = db.session.query(User).filter_by(user_id=user_id).first()
+        if user is None:
+            return None
+        db.session.expunge(user)
+        user_cache.set(user_id, user)
+        cached = user
+    # 問い合わせずにこのリクエストのセッションに入れる
+    return db.session.merge(cached, load=False)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -166,135 +658,992 @@ def logout():
     return redirect(url_for('index'))
 
 
+_score_board_cache = {'generation': None}
+_score_board_lock = threading.Lock()
+
+
+def get_score_board():
+    # リーダーボード部分は全ユーザで共通なので，世代番号が変わるまで使い回す
+    generation = score_generation['value']
+    cache = _score_board_cache
+    if cache['generation'] == generation:
+        return cache
+    with _score_board_lock:
+        if cache['generation'] == generation:
+            return cache
+        columns = ['users.print_name', 's.created_at', 's.comment',
+                   's.Company', 's.City', 's.Overall', 'users.n_submit']
+        sort_key = 'Overall'
+        ascending = False
+        sql_text = "select {} from leaderboard as l".format(', '.join(columns)) \
+            + " inner join scores as s on l.score_id = s.id " \
+            + " inner join users on l.user_primary_key = users.id " \
+            + " order by l.{} {}".format(sort_key, 'ASC' if ascending else 'DESC')
+        results = db.session.execute(sql_text)
+        score_table = list(map(dict, results.fetchall()))
+        cache['html'] = render_template(
+            './_score_board.html', score_table=score_table)
+        cache['score_table'] = score_table
+        cache['generation'] = generation
+    return cache
+
+
+def not_modified(etag):
+    # 304 を返せる場合はそのレスポンスを返す
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return None
+
+
 @app.route('/', methods=['GET'])
 def index():
+    recent_jobs = []
+    if current_user.is_authenticated:
+        recent_jobs = db.session.query(Job).filter_by(
+            user_primary_key=current_user.id
+        ).order_by(Job.created_at.desc()).limit(5).all()
+    # フラッシュメッセージがある時は必ず描画する
+    etag = None
+    if '_flashes' not in session:
+        etag = hashlib.md5('{}:{}:{}'.format(
+            score_state_tag(),
+            current_user.get_id() if current_user.is_authenticated else '',
+            [(job.id, job.status) for job in recent_jobs]
+        ).encode('utf-8')).hexdigest()
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
     login_form = LoginForm()
     upload_form = UploadForm()
-    columns = ['print_name', 'created_at', 'comment',
-               'Company', 'City', 'Overall', 'n_submit']
-    sort_key = 'Overall'
-    ascending = False
+    score_board = get_score_board()
+
+    response = make_response(render_template(
+        './index.html', login_form=login_form, upload_form=upload_form,
+        current_user=current_user, score_board=score_board['html'],
+        recent_jobs=recent_jobs))
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/api/leaderboard', methods=['GET'])
+def leaderboard_json():
+    etag = 'scores-{}'.format(score_state_tag())
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    response = jsonify(get_score_board()['score_table'])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def encode_cursor(row):
+    # カーソルには作った時の score_state の epoch も入れる
+    return base64.urlsafe_b64encode(
+        '{}|{}|{}'.format(row['created_at'], row['id'], _score_state['epoch'] or 0
+                          ).encode('utf-8')
+    ).decode('ascii')
+
+
+def decode_cursor(cursor):
+    # (created_at, id, epoch) を返す (epoch を含まない古いカーソルは None)
+    fields = base64.urlsafe_b64decode(
+        cursor.encode('ascii')).decode('utf-8').split('|')
+    if len(fields) == 2:
+        fields.append(None)
+    created_at, score_id, epoch = fields
+    return created_at, int(score_id), None if epoch is None else int(epoch)
+
+
+def parse_utc(timestring):
+    # scores.created_at と同じ形式 (UTC) に揃える
+    date = parser.parse(timestring)
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone('UTC'))
+    return date.strftime('%Y-%m-%d %H:%M:%S')
+
+
+@app.route('/api/history', methods=['GET'])
+def history_json():
+    """
+    スコアの履歴を (created_at, id) のキーセットでページ分割して返す
+      user : チーム名 (print_name) で絞り込み
+      from, to : 提出日時の範囲 (タイムゾーンなしは UTC とみなす)
+      since : 指定したカーソルより後の提出を古い順に返す (差分の取得・順方向のページ送り)
+      before : 指定したカーソルより前の提出を新しい順に返す (指定しない場合は最新から)
+      limit : 件数 (最大 1000)
+    since のカーソルを作った後に再採点などで履歴が書き換わった場合は，最初から古い順に返し
+    reset を true にする (手元の履歴を捨てて読み直す)
+    """
+    columns = ['s.id', 'print_name', 'created_at', 'comment',
+               'Company', 'City', 'Overall']
+    # 再採点で置き換えられたものは除く
+    conditions = ["s.superseded_by is null"]
+    params = {}
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        if request.args.get('user') is not None:
+            conditions.append("print_name = :user")
+            params['user'] = request.args['user']
+        if request.args.get('from') is not None:
+            conditions.append("created_at >= :from_")
+            params['from_'] = parse_utc(request.args['from'])
+        if request.args.get('to') is not None:
+            conditions.append("created_at <= :to")
+            params['to'] = parse_utc(request.args['to'])
+        since = request.args.get('since')
+        before = request.args.get('before')
+        reset = False
+        if since is not None:
+            params['c_created_at'], params['c_id'], epoch = decode_cursor(since)
+            if epoch is not None and epoch != (_score_state['epoch'] or 0):
+                # カーソルを作った後に再採点などで履歴が書き換わった
+                reset = True
+                since = None
+            else:
+                conditions.append(
+                    "(created_at > :c_created_at or"
+                    " (created_at = :c_created_at and s.id > :c_id))")
+        elif before is not None:
+            params['c_created_at'], params['c_id'], _ = decode_cursor(before)
+            conditions.append(
+                "(created_at < :c_created_at or"
+                " (created_at = :c_created_at and s.id < :c_id))")
+    except (ValueError, OverflowError, UnicodeDecodeError, binascii.Error):
+        return jsonify({'message': 'invalid parameter'}), 400
+    order = 'ASC' if since is not None or reset else 'DESC'
+    params['limit'] = max(limit, 0)
     sql_text = "select {} from scores as s".format(', '.join(columns)) \
         + " inner join users on s.user_primary_key = users.id " \
-        + " where not exists (select 1 from scores as t where s.user_primary_key" \
-        + " = t.user_primary_key and s.created_at < t.created_at )" \
-        + " order by {} {}".format(sort_key, 'ASC' if ascending else 'DESC')
-    results = db.session.execute(sql_text)
-    score_table = list(map(dict, results.fetchall()))
-    print(score_table[0]['created_at'])
-
-    return render_template(
-        './index.html', login_form=login_form, upload_form=upload_form,
-        current_user=current_user, score_table=score_table)
+        + " where " + " and ".join(conditions) \
+        + " order by created_at {order}, s.id {order} limit :limit".format(order=order)
+    results = db.session.execute(text(sql_text), params)
+    scores = list(map(dict, results.fetchall()))
+    if since is not None:
+        # 新しい提出がなければ同じカーソルで問い合わせ続ければよい
+        next_cursor = encode_cursor(scores[-1]) if scores else since
+    elif reset:
+        next_cursor = encode_cursor(scores[-1]) if scores else None
+    else:
+        next_cursor = encode_cursor(scores[-1]) \
+            if len(scores) == params['limit'] and scores else None
+    return jsonify({'scores': scores, 'next_cursor': next_cursor, 'reset': reset})
+
+
+ORGANIZER_NAME = "YANSハッカソン運営委員"
+_history_cache = {'generation': None, 'epoch': None}
+_history_lock = threading.Lock()
 
 
-# @app.route('/history', methods=['GET'])
-# def get_scores():
-#     user = request.args.get('user', None)
-#     columns = ['print_name', 'created_at', 'comment',
-#                'Company', 'City', 'Overall']
-#     sql_text = "select {} from scores as s".format(', '.join(columns)) \
-#         + " inner join users on s.user_primary_key = users.id " \
-#         + (" where print_name='{}'".format(user) if user is not None else "") \
-#         + " order by created_at DESC"
-#     results = db.session.execute(sql_text)
-#     score_table = list(map(dict, results.fetchall()))
-#     return jsonify(score_table)
+def get_history_json():
+    # Plotly の figure を直接組み立て，新しい Score は該当ユーザのトレースに追記する
+    generation = score_generation['value']
+    epoch = score_generation['epoch']
+    cache = _history_cache
+    if cache['generation'] == generation:
+        return cache['json']
+    with _history_lock:
+        if cache['generation'] == generation:
+            return cache['json']
+        if cache['epoch'] != epoch:
+            cache.update(
+                epoch=epoch, last_id=0, traces={}, shapes=[], annotations=[])
+        columns = ['s.id', 'print_name', 'created_at', 'comment', 'Overall']
+        sql_text = "select {} from scores as s".format(', '.join(columns)) \
+            + " inner join users on s.user_primary_key = users.id " \
+            + " where s.id > :last_id and s.superseded_by is null" \
+            + " order by created_at, s.id"
+        results = db.session.execute(
+            text(sql_text), {'last_id': cache['last_id']})
+        for row in results.fetchall():
+            cache['last_id'] = max(cache['last_id'], row['id'])
+            if row['print_name'] == ORGANIZER_NAME:
+                # 運営のベースラインは水平線で表示 (fig.add_hline 相当)
+                cache['shapes'].append({
+                    'type': 'line', 'xref': 'x domain', 'yref': 'y',
+                    'x0': 0, 'x1': 1, 'y0': row['Overall'], 'y1': row['Overall'],
+                    'line': {'width': 1, 'dash': 'dot'},
+                })
+                cache['annotations'].append({
+                    'text': row['comment'], 'showarrow': False,
+                    'xref': 'x domain', 'yref': 'y', 'x': 0, 'y': row['Overall'],
+                    'xanchor': 'left', 'yanchor': 'top',
+                })
+                continue
+            trace = cache['traces'].get(row['print_name'])
+            if trace is None:
+                trace = cache['traces'][row['print_name']] = {
+                    'type': 'scatter', 'name': row['print_name'],
+                    'mode': 'lines+markers', 'line': {'width': 1},
+                    'x': [], 'y': [], 'text': [],
+                }
+            trace['x'].append(row['created_at'])
+            trace['y'].append(row['Overall'])
+            trace['text'].append(row['comment'])
+        cache['json'] = json.dumps({
+            'data': [cache['traces'][name] for name in sorted(cache['traces'])],
+            'layout': {
+                'yaxis': {'range': [0, 1]},
+                'shapes': cache['shapes'],
+                'annotations': cache['annotations'],
+            },
+        }, ensure_ascii=False)
+        cache['generation'] = generation
+    return cache['json']
 
 
 @app.route('/history', methods=['GET'])
 def visualize():
-    columns = ['print_name', 'created_at', 'comment',
+    return render_template('history.html', graphJSON=get_history_json(),
+                           organizer=ORGANIZER_NAME)
+
+
+@app.route('/api/events', methods=['GET'])
+def score_events_stream():
+    # 採点が終わるたびに新しい Score とリーダーボードの差分を Server-Sent Events で送る
+    subscriber = score_events.subscribe()
+    if subscriber is None:
+        return jsonify({'message': 'too many subscribers'}), 503
+    start_event_relay()
+    response = app.response_class(
+        score_events.stream(subscriber), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # プロキシにバッファさせない
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+CATEGORY_FILES = {
+    'Company.json', 'City.json',
+}
+
+
+def page_dirs(settings, basename):
+    # オフセットの確認に使うページのディレクトリ (プレーンテキスト, HTML)
+    if not app.config['CHECK_OFFSETS']:
+        return (None, None)
+    return tuple(
+        os.path.join(base_dir, settings[key][basename])
+        if basename in settings.get(key, {}) else None
+        for key in ('plain_dict', 'html_dict')
+    )
+
+
+def worker_id():
+    # ジョブを採点するプロセスとして Job.owner に入れる値 (fork した後の pid を使う)
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def is_orphaned(owner):
+    # owner のプロセスが終了していて，採点が続いていないジョブか
+    # (DB は SQLite なので採点するプロセスは全て同じホストにある)
+    if owner is None:
+        return True
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname():
+        return False
+    if int(pid) == os.getpid():
+        # 最初のリクエストの前なのでこのプロセスのジョブはまだない (pid が再利用された場合)
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def enqueue_job(job, reserved=False):
+    settings = load_settings()
+    target_dict = settings['target_dict']
+    annotation_dict = settings['annotation_dict']
+    with zipfile.ZipFile(job.path) as existing_zip:
+        # 大きいファイルから投入して，全体の待ち時間を一番重いカテゴリに近づける
+        fnames = [info.filename for info in sorted(
+            existing_zip.infolist(), key=lambda info: -info.file_size)]
+    tasks = {}
+    for fname in fnames:
+        basename = os.path.basename(fname)
+        if basename in CATEGORY_FILES:
+            annotation_path = os.path.join(
+                base_dir, annotation_dict[basename]
+            )
+            tasks[basename] = (
+                job.path, fname, annotation_path, target_dict[basename],
+                app.config['SCORING_ENGINE'], app.config['SCORING_TIMINGS']
+            ) + page_dirs(settings, basename)
+    # 採点に使う正答データの版 (書き込む時ではなく，ここで決めた版で記録する)
+    versions = {basename: gold_version(basename) for basename in CATEGORY_FILES}
+
+    def lookup(basename, content_hash):
+        return lookup_score(basename, content_hash, versions[basename])
+
+    def callback(job_id, result, error, digests):
+        finish_job(job_id, result, error, digests, versions)
+    scoring_queue.submit(job.id, tasks, callback, on_start=start_job,
+                         lookup=lookup, reserved=reserved)
+
+
+def lookup_score(basename, content_hash, version):
+    # 同じ正答データ (version) で採点済みの同じ内容のファイルがあればその結果を返す
+    with app.app_context():
+        cached = db.session.query(ScoreCache).filter_by(
+            category=basename, gold_version=version,
+            content_hash=content_hash
+        ).first()
+        if cached is None:
+            return None
+        result = {
+            'f1': cached.f1,
+            'offset_type': cached.offset_type,
+            'score': json.loads(cached.score),
+            'counts': cached.counts,
+        }
+        if cached.offset_errors is not None:
+            result.update(json.loads(cached.offset_errors))
+        elif page_dirs(load_settings(), basename) != (None, None):
+            # オフセットを確認せずに採点した結果なので，確認するために採点し直す
+            return None
+        return result
+
+
+def offset_errors_json(r):
+    # ScoreCache.offset_errors に入れる値 (オフセットを確認しなかった場合は None)
+    if 'offset_errors' not in r:
+        return None
+    return json.dumps({
+        'offset_errors': r['offset_errors'],
+        'offset_error_samples': r['offset_error_samples'],
+    }, ensure_ascii=False)
+
+
+# 採点を始めた時刻 (ジョブの処理時間の計測に使う)
+_job_started = {}
+
+
+def start_job(job_id):
+    _job_started[job_id] = time.perf_counter()
+    with app.app_context():
+        db.session.query(Job).filter(
+            Job.id == job_id, Job.status.in_(['queued', 'running'])
+        ).update({'status': 'running'}, synchronize_session=False)
+        db.session.commit()
+
+
+def finish_job(job_id, result, error, digests, versions):
+    # 採点結果の書き込みは score_writer のスレッドでまとめて行う
+    score_writer.put((job_id, result, error, digests, versions))
+
+
+def write_jobs(batch):
+    # score_writer のスレッドから呼ばれるのでアプリケーションコンテキストを作る
+    # (commit の後の処理は after_write_jobs で行う)
+    with app.app_context():
+        try:
+            finished = [record_job(*value) for value in batch]
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return finished
+
+
+def after_write_jobs(batch, finished):
+    # 書き込めたジョブの計測と提出ファイルの削除 (失敗しても書き込みはやり直さない)
+    # (配信は relay_score_events が DB を見て行う)
+    for (job_id, result, _, _, _), (path, status, _) in zip(batch, finished):
+        started = _job_started.pop(job_id, None)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            for basename, r in (result or {}).items():
+                for stage, elapsed in (r.get('timings') or {}).items():
+                    metrics.scoring_stage_duration.observe(
+                        elapsed, category=basename, stage=stage)
+                log_metrics('scoring', job_id=job_id, category=basename,
+                            f1=r['f1'], cached=r['cached'],
+                            timings=r.get('timings'))
+            if started is not None:
+                metrics.job_duration.observe(time.perf_counter() - started, status=status)
+        except Exception:
+            app.logger.exception('cleaning up job %s failed', job_id)
+
+
+def record_job(job_id, result, error, digests, versions):
+    # 採点結果を Score などに書き込む (commit は write_jobs でまとめて行う)
+    # versions は採点を始めた時の正答データの版
+    job = db.session.query(Job).filter_by(id=job_id).first()
+    path = job.path
+    score_id = None
+    if job.status not in ('queued', 'running'):
+        # 他のプロセスが先に書き込んだ場合や，書き込みをやり直した場合は何もしない
+        app.logger.warning('job %s is already %s', job_id, job.status)
+        return path, job.status, None
+    if error is not None:
+        app.logger.error('job %s failed: %r', job_id, error)
+        job.status = 'failed'
+        job.message = ("評価スクリプトが異常終了しました．" +
+                       "データのフォーマット等を見直してください．" +
+                       "({})".format(error))[:256]
+    else:
+        for basename, r in result.items():
+            if not r['cached'] and versions[basename] != gold_version(basename):
+                # 採点中に正答データが変わった場合はどちらの版の結果か分からないので残さない
+                app.logger.warning('gold data of %s changed while scoring job %s',
+                                   basename, job_id)
+            elif not r['cached']:
+                # 同時に同じファイルが採点された場合は先に入った方を残す
+                db.session.execute(
+                    ScoreCache.__table__.insert().prefix_with('OR IGNORE'),
+                    {
+                        'category': basename,
+                        'gold_version': versions[basename],
+                        'content_hash': digests[basename],
+                        'f1': r['f1'],
+                        'offset_type': r['offset_type'],
+                        'score': json.dumps(r['score'], ensure_ascii=False),
+                        'counts': r['counts'],
+                        'offset_errors': offset_errors_json(r),
+                    }
+                )
+                if 'offset_errors' in r:
+                    # 確認せずに採点した結果が先に入っていた場合は確認結果を足す
+                    db.session.query(ScoreCache).filter_by(
+                        category=basename, gold_version=versions[basename],
+                        content_hash=digests[basename], offset_errors=None
+                    ).update({'offset_errors': offset_errors_json(r)},
+                             synchronize_session=False)
+        f1 = {basename: r['f1'] for basename, r in result.items()}
+        f1['overall'] = np.mean(list(f1.values()))
+        f1['user_primary_key'] = job.user_primary_key
+        f1['comment'] = job.comment
+        # 採点中に正答データが変わった場合は古い版として記録し，flask rescore で採点し直す
+        f1['gold_version'] = combined_gold_version(versions)
+        score_record = add_score(f1)
+        score_id = score_record.id
+        for basename, content_hash in digests.items():
+            db.session.add(ScoreFile(
+                score_id=score_record.id, category=basename,
+                content_hash=content_hash,
+                offset_type=result[basename]['offset_type'],
+                counts=result[basename].get('counts')
+            ))
+        db.session.query(User).filter_by(id=job.user_primary_key).update(
+            {User.n_submit: User.n_submit + 1},
+            synchronize_session=False
+        )
+        job.score = score_record
+        job.status = 'done'
+        offset_errors = [
+            '{} {}件'.format(basename, r['offset_errors'])
+            for basename, r in sorted(result.items()) if r.get('offset_errors')
+        ]
+        if offset_errors:
+            job.message = ('オフセットがテキストとずれている行があります: ' +
+                           ', '.join(offset_errors))[:256]
+    job.finished_at = current_timestamp()
+    return path, job.status, score_id
+
+
+def fail_job(value, error):
+    # score_writer で書き込めなかったジョブを失敗として記録し，提出ファイルを消す
+    job_id = value[0]
+    with app.app_context():
+        db.session.rollback()
+        job = db.session.query(Job).filter_by(id=job_id).first()
+        path = None
+        # 既に書き込めていた場合は失敗にしない
+        if job is not None and job.status in ('queued', 'running'):
+            path = job.path
+            job.status = 'failed'
+            job.message = ("採点結果を保存できませんでした．" +
+                           "もう一度提出してください．({})".format(error))[:256]
+            job.finished_at = current_timestamp()
+            db.session.commit()
+    started = _job_started.pop(job_id, None)
+    if started is not None:
+        metrics.job_duration.observe(time.perf_counter() - started, status='failed')
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+
+score_writer = storage.BatchWriter(write_jobs, name='score-writer',
+                                   on_failure=fail_job, after_write=after_write_jobs)
+# 配信は購読者が接続しているプロセスごとに行う (どのプロセスが書き込んだ Score も relay_score_events で届く)
+score_events = events.Broker(max_subscribers=app.config['MAX_EVENT_SUBSCRIBERS'])
+metrics.registry.gauge(
+    'leaderboard_event_subscribers', 'Number of connected /api/events streams.',
+    lambda: len(score_events))
+# 最後に配信したリーダーボード {チーム名: (順位, 行)} (relay_score_events のスレッドだけが使う)
+_published_board = {}
+
+
+def publish_scores(score_ids):
+    # 新しい Score と，順位か内容が変わったリーダーボードの行だけを配信する
+    # (購読者がいない間は差分の基準を更新しないが，次の配信の差分が増えるだけで済む)
+    if not score_ids or not len(score_events):
+        return
+    columns = ['s.id', 'print_name', 'created_at', 'comment',
                'Company', 'City', 'Overall']
-    sql_text = "select {} from scores as s".format(', '.join(columns)) \
-        + " inner join users on s.user_primary_key = users.id " \
-        + " order by created_at DESC"
-    results = db.session.execute(sql_text)
-    df_all = pd.DataFrame(list(map(dict, results.fetchall())))
-    fig = go.Figure(layout_yaxis_range=[0, 1])
-    for group_name, df in df_all.groupby("print_name"):
-        if group_name == "YANSハッカソン運営委員":
-            for row in df.iterrows():
-                fig.add_hline(y=row[1]["Overall"], annotation_text=row[1].comment, line=dict(
-                    width=1, dash="dot", annotation_position="bottom left"))
+    sql_text = text(
+        "select {} from scores as s".format(', '.join(columns))
+        + " inner join users on s.user_primary_key = users.id "
+        + " where s.id in :ids order by created_at, s.id"
+    ).bindparams(db.bindparam('ids', expanding=True))
+    scores = list(map(dict, db.session.execute(
+        sql_text, {'ids': score_ids}).fetchall()))
+    board = get_score_board()['score_table']
+    changed = []
+    current = {}
+    for rank, row in enumerate(board, 1):
+        current[row['print_name']] = (rank, row)
+        if _published_board.get(row['print_name']) != (rank, row):
+            changed.append(dict(row, rank=rank))
+    _published_board.clear()
+    _published_board.update(current)
+    score_events.publish('scores', {
+        'scores': scores, 'leaderboard': changed, 'size': len(board)})
+
+
+def publish_reset():
+    # 既存の Score が書き換えられた場合は差分を送らず，読み直すように知らせる
+    _published_board.clear()
+    _published_board.update(
+        (row['print_name'], (rank, row))
+        for rank, row in enumerate(get_score_board()['score_table'], 1))
+    score_events.publish('reset', {})
+
+
+# relay_score_events が最後に配信した時の DB の epoch と最大の Score の id
+_relayed = {'thread': None, 'epoch': None, 'max_id': None}
+_relay_lock = threading.Lock()
+
+
+def start_event_relay():
+    # 最初の購読者が来た時に配信用のスレッドを起動する
+    with _relay_lock:
+        if _relayed['thread'] is None:
+            _relayed['thread'] = threading.Thread(
+                target=relay_score_events, name='score-events', daemon=True)
+            _relayed['thread'].start()
+
+
+def relay_score_events():
+    # score_state の epoch と max(scores.id) を SCORE_STATE_INTERVAL 秒ごとに見て，
+    # どのプロセス (別のワーカーや flask rescore) が書き込んだ Score も配信する
+    while True:
+        try:
+            with app.app_context():
+                relay_score_state()
+        except Exception:
+            app.logger.exception('relaying score events failed')
+        time.sleep(app.config['SCORE_STATE_INTERVAL'])
+
+
+def relay_score_state():
+    refresh_score_state()
+    epoch, max_id = _score_state['epoch'], _score_state['max_id']
+    last_epoch, last_max_id = _relayed['epoch'], _relayed['max_id']
+    _relayed['epoch'], _relayed['max_id'] = epoch, max_id
+    if last_epoch is None or not len(score_events):
+        return
+    if epoch != last_epoch:
+        publish_reset()
+    elif max_id != last_max_id:
+        score_ids = [row[0] for row in db.session.execute(text(
+            "select id from scores where id > :last_max_id"),
+            {'last_max_id': last_max_id or 0}).fetchall()]
+        publish_scores(score_ids)
+
+
+@app.before_first_request
+def resume_jobs():
+    # 再起動前に終わらなかったジョブをキューに戻す
+    # 他のワーカープロセスが採点中のジョブは戻さない
+    for job in db.session.query(Job).filter(
+            Job.status.in_(['queued', 'running'])).all():
+        if not is_orphaned(job.owner):
+            continue
+        # 同時に起動した他のプロセスと取り合いにならないように owner を書き換えられた方が引き継ぐ
+        claimed = db.session.query(Job).filter(
+            Job.id == job.id, Job.status.in_(['queued', 'running']),
+            Job.owner.is_(None) if job.owner is None else Job.owner == job.owner
+        ).update({'owner': worker_id()}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            continue
+        db.session.refresh(job)
+        if os.path.exists(job.path):
+            job.status = 'queued'
+            db.session.commit()
+            enqueue_job(job)
         else:
-            fig.add_scatter(
-                x=df.created_at.values, y=df.Overall.values,
-                text=df.comment,
-                # visible='legendonly',
-                name=group_name, mode="lines+markers",
-                line=dict(
-                    width=1,
-                )
-            )
-    graphJSON = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
-    return render_template('history.html', graphJSON=graphJSON)
+            job.status = 'failed'
+            job.message = "提出ファイルが見つかりません．"
+            db.session.commit()
+
+
+def format_validation_error(e):
+    if e['file'] is None:
+        return e['message']
+    if e['line'] is None:
+        return "{}: {}".format(e['file'], e['message'])
+    return "{} {}行目: {}".format(e['file'], e['line'], e['message'])
+
+
+def check_submit_limits(user):
+    # ユーザごとの提出の制限を確かめ，超えていれば (理由, 再提出できるまでの秒数) を返す
+    if user.is_admin:
+        return None
+    pending = db.session.query(Job).filter(
+        Job.user_primary_key == user.id,
+        Job.status.in_(['queued', 'running'])).count()
+    limit = app.config['USER_MAX_PENDING_JOBS']
+    if limit is not None and pending >= limit:
+        return ("採点待ちの提出が{}件あります．".format(pending) +
+                "採点が終わってから提出してください．", 30)
+    quota = app.config['SUBMIT_QUOTA']
+    if quota is not None:
+        # current_user はキャッシュしたものなので提出回数は問い合わせる
+        n_submit = db.session.query(User.n_submit).filter_by(id=user.id).scalar()
+        if (n_submit or 0) + pending >= quota:
+            return "提出回数の上限 ({}回) に達しました．".format(quota), None
+    rate_limit = app.config['SUBMIT_RATE_LIMIT']
+    if rate_limit is not None:
+        window = app.config['SUBMIT_RATE_WINDOW']
+        now = datetime.utcnow()
+        recent = db.session.query(Job.created_at).filter(
+            Job.user_primary_key == user.id,
+            Job.created_at >= now - timedelta(seconds=window)
+        ).order_by(Job.created_at.desc()).limit(rate_limit).all()
+        if len(recent) >= rate_limit:
+            oldest = parser.parse(str(recent[-1].created_at))
+            retry_after = (oldest + timedelta(seconds=window) - now).total_seconds()
+            return ("提出回数の上限 ({}秒間に{}回) に達しました．".format(window, rate_limit) +
+                    "しばらくしてから提出してください．", max(retry_after, 1))
+    return None
+
+
+def reject_submission(message, retry_after=None):
+    # 受け付けられない提出は 429 で断る (画面からの提出はメッセージを出してトップに戻す)
+    log_metrics('rejected', user_id=current_user.user_id, message=message)
+    if request.accept_mimetypes.best == 'application/json':
+        response = jsonify({'message': message})
+        response.status_code = 429
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(int(retry_after))
+        return response
+    flash(message, "failed")
+    return redirect(url_for('index'))
 
 
 @app.route('/upload', methods=['POST'])
 def upload_and_evaluate():
-    filenames = {
-        'Company.json', 'City.json',
+    # ログインしていない場合は何も読まずに断る
+    if not current_user.is_authenticated:
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'message': 'login required'}), 401
+        flash("ログインしてから提出してください．", "failed")
+        return redirect(url_for('index'))
+    # 制限を超えた・混んでいる場合は提出ファイルを読む前に断る
+    rejected = check_submit_limits(current_user)
+    if rejected is not None:
+        return reject_submission(*rejected)
+    if not scoring_queue.reserve():
+        return reject_submission(
+            "採点待ちの提出が多いため受け付けられません．" +
+            "しばらくしてから提出してください．", 60)
+    # 確保した枠はキューに入れなかった場合に返す
+    enqueued = False
+    try:
+        if not validation_slots.acquire(timeout=app.config['VALIDATION_WAIT']):
+            return reject_submission(
+                "提出が混み合っています．しばらくしてから提出してください．", 10)
+        try:
+            upload_form = UploadForm()
+            f = upload_form.zip_file.data
+            description = upload_form.description.data
+            # 形式の誤りは採点を始める前に返す
+            settings = load_settings()
+            enes = {
+                basename: scoring.load_ene(
+                    os.path.join(base_dir, settings['annotation_dict'][basename]))
+                for basename in CATEGORY_FILES
+            }
+            errors = validation.validate_submission(
+                f, enes, settings['target_dict'], app.config['VALIDATE_TARGET_PAGES'],
+                app.config['VALIDATION_MAX_ERRORS'])
+        finally:
+            validation_slots.release()
+        if errors:
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify({'message': 'invalid submission', 'errors': errors}), 400
+            flash("ファイル構成が正しくありません" if errors[0]['file'] is None
+                  else "提出ファイルの形式が正しくありません", "failed")
+            for e in errors[:5]:
+                flash(format_validation_error(e), "failed")
+            return redirect(url_for('index'))
+
+        # 提出ファイルを保存してからキューに入れる
+        job_id = uuid.uuid4().hex
+        os.makedirs(app.config['UPLOAD_DIR'], exist_ok=True)
+        path = os.path.join(app.config['UPLOAD_DIR'], job_id + '.zip')
+        f.seek(0)
+        f.save(path)
+        job = Job(
+            id=job_id, user_primary_key=current_user.id,
+            comment=str(description), path=path, status='queued',
+            owner=worker_id()
+        )
+        db.session.add(job)
+        db.session.commit()
+        enqueue_job(job, reserved=True)
+        enqueued = True
+    finally:
+        if not enqueued:
+            scoring_queue.release()
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({
+            'job_id': job_id,
+            'status_url': url_for('job_status', job_id=job_id)
+        }), 202
+    flash("提出を受け付けました．採点が終わるとリーダーボードに反映されます．" +
+          "(ジョブID: {})".format(job_id))
+    return redirect(url_for('index'))
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = db.session.query(Job).filter_by(id=job_id).first()
+    if job is None or not current_user.is_authenticated or \
+            (job.user_primary_key != current_user.id and not current_user.is_admin):
+        return jsonify({'message': 'not found'}), 404
+    return jsonify(job.to_dict())
+
+
+def score_breakdown(score_id):
+    # 提出の属性ごとのスコア (保存した TP,TPFP,TPFN から計算するので採点し直さない)
+    # 提出者本人か管理者でなければ None
+    score = db.session.query(Score).filter_by(id=score_id).first()
+    if score is None or not current_user.is_authenticated or \
+            (score.user_primary_key != current_user.id and not current_user.is_admin):
+        return None
+    categories = {}
+    for score_file in db.session.query(ScoreFile).filter_by(
+            score_id=score_id).order_by(ScoreFile.category):
+        if score_file.counts is None:
+            # 内訳を保存する前の提出
+            categories[score_file.category] = None
+            continue
+        counts = jobs.unpack_counts(score_file.counts)
+        categories[score_file.category] = {
+            'offset_type': score_file.offset_type,
+            'counts': counts,
+            'score': scoring.aggregate(counts),
+        }
+    return {
+        'score_id': score.id,
+        'created_at': str(score.created_at),
+        'comment': score.comment,
+        'Company': score.Company,
+        'City': score.City,
+        'Overall': score.Overall,
+        'gold_version': score.gold_version,
+        'superseded_by': score.superseded_by,
+        'categories': categories,
     }
-    settings = json.load(open(base_dir + '/data/settings.json', 'r'))
-    target_dict = settings['target_dict']
-    annotation_dict = settings['annotation_dict']
-    upload_form = UploadForm()
-    f = upload_form.zip_file.data
-    description = upload_form.description.data
-    # tmpdirに展開して一番目の要素を返す
-    with tempfile.TemporaryDirectory() as td:
-        with zipfile.ZipFile(f) as existing_zip:
-            fnames = existing_zip.namelist()
-            result = {}
-
-            for fname in fnames:
-                basename = os.path.basename(fname)
-                if basename in filenames:
-                    try:
-                        submit_data = [
-                            json.loads(line) for line in
-                            existing_zip.open(fname, 'r').readlines()
-                        ]
-                        annotation_path = os.path.join(
-                            base_dir, annotation_dict[basename]
-                        )
-                        target = target_dict[basename]
-                        score_dict = scoring.get_score(
-                            answer=annotation_path,
-                            result=submit_data,
-                            target=target
-                        )
-                        # 森羅LBと同様，'text_offset' が含まれるデータは 'text' での結果を採用
-                        print(basename)
-                        if 'text' in score_dict:
-                            f1 = score_dict['text']['micro_ave']['F1']
-                            print('text', score_dict['text']['micro_ave'])
-                        else:
-                            f1 = score_dict['html']['micro_ave']['F1']
-                            print('html', score_dict['html']['micro_ave'])
-                        result[basename] = f1
-                    except:
-                        flash("評価スクリプトが異常終了しました．" +
-                              "データのフォーマット等を見直してください．", "failed")
-                        return redirect(url_for('index'))
-                else:
-                    continue
 
-            if set(result.keys()) != filenames:
-                flash("ファイル構成が正しくありません", "failed")
-                return redirect(url_for('index'))
 
-    result['overall'] = np.mean(list(result.values()))
-    result['user_primary_key'] = current_user.id
-    result['comment'] = str(description)
+@app.route('/scores/<int:score_id>', methods=['GET'])
+def score_detail(score_id):
+    breakdown = score_breakdown(score_id)
+    if breakdown is None:
+        abort(404)
+    return render_template('score.html', breakdown=breakdown,
+                           current_user=current_user)
+
+
+@app.route('/api/scores/<int:score_id>', methods=['GET'])
+def score_detail_json(score_id):
+    breakdown = score_breakdown(score_id)
+    if breakdown is None:
+        return jsonify({'message': 'not found'}), 404
+    return jsonify(breakdown)
+
+
+def supersede_score(old, results, version, hashes):
+    # 再採点の結果で old を置き換える (提出日時・コメントは元の提出のものを使う)
+    # results : {ファイル名: {'f1', 'offset_type', 'counts'}}
+    f1 = {basename: r['f1'] for basename, r in results.items()}
+    result = dict(f1)
+    result['overall'] = np.mean(list(f1.values()))
+    result['user_primary_key'] = old.user_primary_key
+    result['comment'] = old.comment
+    result['gold_version'] = version
     score_record = Score(result)
+    # 文字列として同じ値になるよう，DB上で元の提出日時をそのまま写す
+    score_record.created_at = db.select(
+        [Score.created_at]).where(Score.id == old.id).as_scalar()
     db.session.add(score_record)
-    user_record = db.session.query(User).filter_by(id=current_user.id).first()
-    user_record.n_submit += 1
+    db.session.flush()
+    old.superseded_by = score_record.id
+    for basename, content_hash in hashes.items():
+        db.session.add(ScoreFile(
+            score_id=score_record.id, category=basename,
+            content_hash=content_hash,
+            offset_type=results[basename]['offset_type'],
+            counts=results[basename]['counts']
+        ))
+    db.session.query(Job).filter_by(score_id=old.id).update(
+        {'score_id': score_record.id}, synchronize_session=False)
+    refresh_leaderboard(old.user_primary_key)
+    return score_record
+
+
+@app.cli.command('rescore')
+@click.option('--user', 'user_id', help='ユーザIDで絞り込む')
+@click.option('--since', help='この日時以降の提出だけを採点し直す (タイムゾーンなしは UTC)')
+@click.option('--until', help='この日時以前の提出だけを採点し直す (タイムゾーンなしは UTC)')
+@click.option('--workers', type=int, default=None,
+              help='採点に使うプロセス数 (指定しない場合は CPU コア数)')
+@click.option('--dry-run', is_flag=True, help='対象の件数だけを表示する')
+def rescore(user_id, since, until, workers, dry_run):
+    """
+    保存した提出ファイルを現在の正答データで採点し直し，新しい Score で置き換える
+    (中断しても，もう一度実行すれば残りから続ける)
+    """
+    settings = load_settings()
+    archive_dir = app.config['ARCHIVE_DIR']
+    version = combined_gold_version()
+    versions = {basename: gold_version(basename) for basename in CATEGORY_FILES}
+
+    # 現在の正答データで採点されていない提出
+    query = db.session.query(Score).filter(
+        Score.superseded_by.is_(None),
+        db.or_(Score.gold_version.is_(None), Score.gold_version != version))
+    if user_id is not None:
+        query = query.join(User, Score.user_primary_key == User.id).filter(
+            User.user_id == user_id)
+    if since is not None:
+        query = query.filter(Score.created_at >= parser.parse(parse_utc(since)))
+    if until is not None:
+        query = query.filter(Score.created_at <= parser.parse(parse_utc(until)))
+    stale = query.order_by(Score.created_at, Score.id).all()
+
+    files = {}
+    for score_id, basename, content_hash in db.session.query(
+            ScoreFile.score_id, ScoreFile.category, ScoreFile.content_hash):
+        files.setdefault(score_id, {})[basename] = content_hash
+    targets = []
+    n_missing = 0
+    for score in stale:
+        hashes = files.get(score.id, {})
+        if set(hashes) != CATEGORY_FILES or archive_dir is None or not all(
+                os.path.exists(jobs.archive_path(archive_dir, content_hash))
+                for content_hash in hashes.values()):
+            n_missing += 1
+            continue
+        targets.append((score, hashes))
+    click.echo('{} 件を再採点します (提出ファイルが保存されていない {} 件は除く)'.format(
+        len(targets), n_missing))
+    if dry_run or not targets:
+        return
+
+    # 同じ内容のファイルは1回だけ採点し，採点済みのものは score_cache から使う
+    results = {}
+    pending = {(basename, content_hash)
+               for _, hashes in targets for basename, content_hash in hashes.items()}
+    for cached in db.session.query(ScoreCache).filter(
+            ScoreCache.gold_version.in_(list(versions.values()))):
+        key = (cached.category, cached.content_hash)
+        if key in pending and versions[cached.category] == cached.gold_version:
+            results[key] = {'f1': cached.f1, 'offset_type': cached.offset_type,
+                            'counts': cached.counts}
+    pending -= set(results)
+
+    annotation_paths = {
+        basename: os.path.join(base_dir, settings['annotation_dict'][basename])
+        for basename in CATEGORY_FILES
+    }
+    failed = set()
+    # 各プロセスで正答データを1回だけ読み込む
+    with ProcessPoolExecutor(
+            max_workers=workers, initializer=jobs.load_annotations,
+            initargs=(list(annotation_paths.values()),)) as pool:
+        futures = {
+            pool.submit(
+                jobs.score_archived, jobs.archive_path(archive_dir, content_hash),
+                annotation_paths[basename], settings['target_dict'][basename],
+                app.config['SCORING_ENGINE']
+            ): (basename, content_hash)
+            for basename, content_hash in sorted(pending)
+        }
+        with click.progressbar(as_completed(futures), length=len(futures),
+                               label='採点') as bar:
+            for future in bar:
+                basename, content_hash = futures[future]
+                try:
+                    r = future.result()
+                except Exception as e:
+                    app.logger.error('rescoring %s %s failed: %r',
+                                     basename, content_hash, e)
+                    failed.add((basename, content_hash))
+                    continue
+                # 結果はすぐに保存して，中断した場合も採点し直さなくてよいようにする
+                db.session.execute(
+                    ScoreCache.__table__.insert().prefix_with('OR IGNORE'),
+                    {
+                        'category': basename,
+                        'gold_version': versions[basename],
+                        'content_hash': content_hash,
+                        'f1': r['f1'],
+                        'offset_type': r['offset_type'],
+                        'score': json.dumps(r['score'], ensure_ascii=False),
+                        'counts': r['counts'],
+                    }
+                )
+                db.session.commit()
+                results[(basename, content_hash)] = r
+
+    n_done = 0
+    with click.progressbar(targets, label='置き換え') as bar:
+        for score, hashes in bar:
+            if any(key in failed for key in hashes.items()):
+                continue
+            supersede_score(score, {
+                basename: results[(basename, content_hash)]
+                for basename, content_hash in hashes.items()
+            }, version, hashes)
+            n_done += 1
+            if n_done % 100 == 0:
+                db.session.commit()
     db.session.commit()
-    return redirect(url_for('index'))
+    click.echo('{} 件を置き換えました (採点に失敗したファイルを含む {} 件は除く)'.format(
+        n_done, len(targets) - n_done))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_text():
+    token = app.config['METRICS_TOKEN']
+    authorized = current_user.is_authenticated and current_user.is_admin
+    if not authorized and token is not None:
+        authorized = request.headers.get('Authorization') == 'Bearer ' + token
+    if not authorized:
+        return jsonify({'message': 'not found'}), 404
+    response = make_response(metrics.registry.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
 
 
 if __name__ == '__main__':
+    if os.path.exists(settings_path):
+        preload_annotations()
     app.run(host="0.0.0.0", port=8001, debug=True)
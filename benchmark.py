@@ -0,0 +1,579 @@
+"""
+採点処理のベンチマーク
+
+  python benchmark.py decode --lines 200000
+  python benchmark.py scoring --pages 2000 --output before.json
+  python benchmark.py app --users 20 --uploads 3 --output before.json
+  python benchmark.py sqlite --readers 8 --writers 4 --duration 10
+  python benchmark.py compare before.json after.json
+
+scoring, app, sqlite は森羅形式の正答データと提出データを合成して計測し，
+結果をjsonで出力します(compareで2つの結果を比較できます)。
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import defaultdict
+import numpy as np
+import jobs
+import scoring
+
+
+def generate_lines(n_lines, n_pages=1000, n_attributes=30, seed=0,
+                   ene="1.4.6.2"):
+    """
+    森羅形式のワンライナーjsonの行を生成
+    """
+    rng = random.Random(seed)
+    lines = []
+    for i in range(n_lines):
+        offsets = {}
+        for offset_type in scoring.OFFSET_TYPES:
+            start_line = rng.randint(0, 200)
+            offsets[offset_type] = {
+                "start": {"line_id": start_line, "offset": rng.randint(0, 80)},
+                "end": {"line_id": start_line + rng.randint(0, 1),
+                        "offset": rng.randint(0, 80)},
+                "text": "テキスト{}".format(i),
+            }
+        lines.append(json.dumps(dict({
+            "page_id": str(rng.randrange(n_pages)),
+            "title": "タイトル",
+            "attribute": "属性{}".format(rng.randrange(n_attributes)),
+            "ENE": ene,
+        }, **offsets), ensure_ascii=False) + "\n")
+    return lines
+
+
+def random_offset(rng):
+    start_line = rng.randint(0, 200)
+    return {
+        "start": {"line_id": start_line, "offset": rng.randint(0, 80)},
+        "end": {"line_id": start_line + rng.randint(0, 1),
+                "offset": rng.randint(0, 80)},
+        "text": "テキスト",
+    }
+
+
+def generate_dataset(n_pages=1000, n_attributes=30, attributes_per_page=10,
+                     offsets_per_attribute=3, overlap=0.6, noise=0.3,
+                     target_ratio=0.5, offset_types=scoring.OFFSET_TYPES,
+                     seed=0, ene="1.4.6.2"):
+    """
+    正答データと提出データの行，採点対象のpage_idを生成
+      overlap : 正答のオフセットのうち提出データにそのまま含める割合
+      noise : 正答のオフセット1つあたりに提出データへ加える誤りの数(期待値)
+      target_ratio : 採点対象にする正答のページの割合
+      offset_types : 含めるオフセットの種類 ("html_offset", "text_offset")
+    """
+    rng = random.Random(seed)
+    attributes = ["属性{}".format(i) for i in range(n_attributes)]
+    gold, submission = [], []
+    for page in range(n_pages):
+        page_id = str(100000 + page)
+        for attribute in rng.sample(attributes, min(attributes_per_page, n_attributes)):
+            for _ in range(rng.randint(1, offsets_per_attribute)):
+                line = {"page_id": page_id, "title": "タイトル{}".format(page),
+                        "attribute": attribute, "ENE": ene}
+                for offset_type in offset_types:
+                    line[offset_type] = random_offset(rng)
+                gold.append(line)
+                if rng.random() < overlap:
+                    submission.append(line)
+                if rng.random() < noise:
+                    wrong = dict(line)
+                    for offset_type in offset_types:
+                        wrong[offset_type] = random_offset(rng)
+                    submission.append(wrong)
+    rng.shuffle(submission)
+    pages = sorted({line["page_id"] for line in gold})
+    target = rng.sample(pages, int(len(pages) * target_ratio))
+    return (
+        [json.dumps(line, ensure_ascii=False) + "\n" for line in gold],
+        [json.dumps(line, ensure_ascii=False) + "\n" for line in submission],
+        target,
+    )
+
+
+def write_lines(path, lines):
+    with open(path, "w", encoding="utf_8") as f:
+        f.writelines(lines)
+    return path
+
+
+def timeit(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(fn, repeat=3):
+    """
+    fnの実行時間(秒)の最小値，平均値
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "mean": sum(times) / len(times), "repeat": repeat}
+
+
+def bench_decode(lines, repeat=3):
+    """
+    行のデコード速度(lines/s)
+      json.loads : 変更前と同じく行全体を辞書にする
+      decode_lines(名前) : 必要な項目だけを取り出す
+    """
+    data = [line.encode("utf-8") for line in lines]
+    results = {}
+    elapsed = timeit(lambda: [json.loads(line) for line in data], repeat)
+    results["json.loads"] = len(data) / elapsed
+    for name in scoring.JSON_DECODERS:
+        elapsed = timeit(
+            lambda: list(scoring.decode_lines(data, name)), repeat)
+        results["decode_lines({})".format(name)] = len(data) / elapsed
+    return results
+
+
+def bench_scoring(dataset, work_dir, repeat=3):
+    """
+    採点の各段階の実行時間
+      get_annotation 〜 calc_macro : 変更前と同じ(1行ずつ辞書にする)採点の各段階
+      get_score(engine) : 正答データのキャッシュがない状態から / ある状態からの採点
+    各エンジンの micro_ave, macro_ave が変更前の採点と一致しない場合は失敗とする
+    """
+    gold_lines, submission_lines, target = dataset
+    gold_path = write_lines(os.path.join(work_dir, "gold.jsonl"), gold_lines)
+    submission_path = write_lines(
+        os.path.join(work_dir, "submission.jsonl"), submission_lines)
+    offset_type = "text_offset" if '"text_offset"' in gold_lines[0] else "html_offset"
+
+    results = {}
+    results["get_annotation"] = measure(
+        lambda: scoring.get_annotation(gold_path), repeat)
+    answer = scoring.get_annotation(gold_path)
+    result = scoring.get_annotation(submission_path)
+    ene = scoring.get_ene(answer)
+    results["liner2dict"] = measure(
+        lambda: scoring.liner2dict(answer, ene), repeat)
+    answer_dict, _, _, attributes = scoring.liner2dict(answer, ene)
+    result_dict = scoring.liner2dict(result, ene)[0]
+    results["clean"] = measure(
+        lambda: scoring.clean(answer_dict, offset_type), repeat)
+    results["scoring"] = measure(
+        lambda: scoring.scoring(answer_dict, result_dict, target,
+                                attributes, offset_type), repeat)
+    score = scoring.scoring(answer_dict, result_dict, target,
+                            attributes, offset_type)
+    per_attribute = {attribute: item for attribute, item in score.items()
+                     if attribute not in ("macro_ave", "micro_ave")}
+    # calc_micro の計算量は属性の数だけで決まるので件数は仮の値でよい
+    counter = {attribute: {"TP": 1, "TPFP": 2, "TPFN": 3}
+               for attribute in attributes}
+    results["calc_micro"] = measure(lambda: scoring.calc_micro(counter), repeat)
+    results["calc_macro"] = measure(
+        lambda: scoring.calc_macro(per_attribute), repeat)
+
+    # 採点エンジンによって結果が変わらないことを確認する
+    expected = {key: score[key] for key in ("micro_ave", "macro_ave")}
+    for engine in scoring.SCORING_ENGINES:
+        def cold():
+            scoring._gold_cache.clear()
+            with open(submission_path, "rb") as f:
+                scoring.get_score(gold_path, f, target, engine=engine,
+                                  offset_type="auto")
+
+        def warm():
+            with open(submission_path, "rb") as f:
+                scoring.get_score(gold_path, f, target, engine=engine,
+                                  offset_type="auto")
+        results["get_score({}, cold)".format(engine)] = measure(cold, repeat)
+        results["get_score({}, warm)".format(engine)] = measure(warm, repeat)
+
+        with open(submission_path, "rb") as f:
+            engine_score = scoring.get_score(gold_path, f, target, engine=engine,
+                                             offset_type="auto")
+        engine_score = engine_score[offset_type.split("_")[0]]
+        results["get_score({}, warm)".format(engine)]["failures"] = [
+            "{} differs: {} != {}".format(key, engine_score[key], value)
+            for key, value in expected.items() if engine_score[key] != value]
+    return results
+
+
+def make_zip(files):
+    """
+    {zip内のファイル名: 行のリスト} から提出用のzipを作る
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as submit_zip:
+        for fname, lines in files.items():
+            submit_zip.writestr(fname, "".join(lines))
+    return buffer.getvalue()
+
+
+def setup_app(args, work_dir, n_submissions):
+    """
+    一時ディレクトリのDBと合成した正答データで app を読み込み，args.users 人のユーザを作る
+    戻り値は app モジュールと提出用のzipのリスト
+    """
+    # app を読み込む前に一時ディレクトリのDBと設定を使うようにする
+    os.makedirs(os.path.join(work_dir, "uploads"))
+    settings = {"annotation_dict": {}, "target_dict": {}}
+    submissions = defaultdict(dict)
+    for i, (basename, ene) in enumerate((("Company.json", "1.4.6.2"),
+                                         ("City.json", "1.5.1.1"))):
+        gold_lines, submission_lines, target = generate_dataset(**dict(
+            dataset_options(args), seed=args.seed + i, ene=ene))
+        gold_path = write_lines(
+            os.path.join(work_dir, basename + "l"), gold_lines)
+        settings["annotation_dict"][basename] = gold_path
+        settings["target_dict"][basename] = target
+        # 提出ごとに行を減らして，採点結果のキャッシュに当たらないようにする
+        for n in range(n_submissions):
+            submissions[n]["submission/" + basename] = submission_lines[n:]
+    settings_path = os.path.join(work_dir, "settings.json")
+    with open(settings_path, "w") as f:
+        json.dump(settings, f, ensure_ascii=False)
+    os.environ["LEADERBOARD_SETTINGS"] = settings_path
+    os.environ["LEADERBOARD_DATABASE_URI"] = "sqlite:///" + \
+        os.path.join(work_dir, "db.sqlite3")
+    os.environ["LEADERBOARD_ARCHIVE_DIR"] = os.path.join(work_dir, "archive")
+    import app as leaderboard
+    leaderboard.app.config["WTF_CSRF_ENABLED"] = False
+    leaderboard.app.config["UPLOAD_DIR"] = os.path.join(work_dir, "uploads")
+    # ユーザごとの提出の制限と待ち行列の上限は外して，採点の処理量を測る
+    leaderboard.app.config["USER_MAX_PENDING_JOBS"] = None
+    leaderboard.app.config["SUBMIT_RATE_LIMIT"] = None
+    leaderboard.scoring_queue.max_waiting = None
+    with leaderboard.app.app_context():
+        for n in range(args.users):
+            leaderboard.db.session.add(leaderboard.User(
+                "user{}".format(n), "password", "チーム{}".format(n)))
+        leaderboard.db.session.commit()
+    leaderboard.preload_annotations()
+    return leaderboard, [make_zip(submissions[n]) for n in range(n_submissions)]
+
+
+def bench_app(args, work_dir):
+    """
+    Flaskのテストクライアントで /upload と / の応答時間，
+    締切直前のように args.users 人が args.uploads 回ずつ続けて提出した時に
+    全ての採点が終わるまでの時間を計測
+    """
+    n_submissions = args.users * args.uploads
+    leaderboard, zips = setup_app(args, work_dir, n_submissions)
+
+    clients = []
+    for n in range(args.users):
+        client = leaderboard.app.test_client()
+        client.post("/login", data={
+            "user_id": "user{}".format(n), "password": "password"})
+        clients.append(client)
+
+    def upload(client, data):
+        response = client.post(
+            "/upload", content_type="multipart/form-data",
+            headers={"Accept": "application/json"},
+            data={"zip_file": (io.BytesIO(data), "submission.zip"),
+                  "description": "benchmark"})
+        assert response.status_code == 202, response.status_code
+        return response.get_json()["status_url"]
+
+    def wait(client, status_urls):
+        for status_url in status_urls:
+            while True:
+                status = client.get(status_url).get_json()["status"]
+                if status in ("done", "failed"):
+                    assert status == "done", status
+                    break
+                time.sleep(0.01)
+
+    results = {}
+    upload_times = []
+    status_urls = []
+    start = time.perf_counter()
+    for n in range(n_submissions):
+        client = clients[n % args.users]
+        upload_start = time.perf_counter()
+        status_urls.append((client, upload(client, zips[n])))
+        upload_times.append(time.perf_counter() - upload_start)
+    for client, status_url in status_urls:
+        wait(client, [status_url])
+    elapsed = time.perf_counter() - start
+    results["/upload"] = {
+        "best": min(upload_times),
+        "mean": sum(upload_times) / len(upload_times),
+        "repeat": len(upload_times),
+    }
+    results["spike(all jobs done)"] = {
+        "best": elapsed, "mean": elapsed, "repeat": 1,
+        "submissions_per_sec": n_submissions / elapsed,
+    }
+
+    # 同じ内容の再提出(採点結果のキャッシュから答える)
+    resubmit_times = []
+    for _ in range(args.repeat):
+        resubmit_start = time.perf_counter()
+        wait(clients[0], [upload(clients[0], zips[0])])
+        resubmit_times.append(time.perf_counter() - resubmit_start)
+    results["resubmit(upload to done)"] = {
+        "best": min(resubmit_times),
+        "mean": sum(resubmit_times) / len(resubmit_times),
+        "repeat": args.repeat,
+    }
+
+    # 採点が終わった直後はリーダーボードを描画し直す
+    results["/ (cold)"] = measure(lambda: clients[0].get("/"), 1)
+    results["/"] = measure(lambda: clients[0].get("/"), args.repeat)
+    return results
+
+
+def summarize(times):
+    """
+    応答時間のリストから最小値・平均値・パーセンタイル
+    """
+    if not times:
+        return {"best": 0.0, "mean": 0.0, "repeat": 0}
+    times = sorted(times)
+    return {
+        "best": times[0],
+        "mean": sum(times) / len(times),
+        "p50": times[len(times) // 2],
+        "p99": times[min(len(times) - 1, int(len(times) * 0.99))],
+        "repeat": len(times),
+    }
+
+
+def bench_sqlite(args, work_dir):
+    """
+    読み込み(/, /api/leaderboard, /api/history)と採点結果の書き込み(finish_job)を
+    args.duration 秒間同時に続け，応答時間とエラー("database is locked" など)の数を計測
+    """
+    leaderboard, _ = setup_app(args, work_dir, 0)
+    app, db = leaderboard.app, leaderboard.db
+    with app.app_context():
+        user_ids = [user.id for user in db.session.query(leaderboard.User)]
+    started = time.perf_counter()
+    deadline = started + args.duration
+    read_times = defaultdict(list)
+    n_submitted = [0]
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    def reader(n):
+        client = app.test_client()
+        client.post("/login", data={
+            "user_id": "user{}".format(n % args.users), "password": "password"})
+        urls = ["/", "/api/leaderboard", "/api/history?limit=50"]
+        i = 0
+        while time.perf_counter() < deadline:
+            url = urls[i % len(urls)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                status = client.get(url).status_code
+            except Exception as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            with lock:
+                if status == 200:
+                    read_times[url].append(elapsed)
+                else:
+                    errors["read {} {}".format(url, status)] += 1
+
+    versions = {basename: leaderboard.gold_version(basename)
+                for basename in leaderboard.CATEGORY_FILES}
+
+    def writer(n):
+        rng = random.Random(n)
+        while time.perf_counter() < deadline:
+            job_id = uuid.uuid4().hex
+            try:
+                # /upload と同じくジョブを作り，採点が終わったものとして書き込む
+                with app.app_context():
+                    db.session.add(leaderboard.Job(
+                        id=job_id, user_primary_key=rng.choice(user_ids),
+                        comment="benchmark", path=os.path.join(work_dir, job_id),
+                        status="running"))
+                    db.session.commit()
+                counts = {"attribute{}".format(i): {"TP": 1, "TPFP": 2, "TPFN": 2}
+                          for i in range(args.attributes)}
+                result = {
+                    basename: {"f1": rng.random(), "offset_type": "text",
+                               "score": {}, "counts": jobs.pack_counts(counts),
+                               "cached": False}
+                    for basename in leaderboard.CATEGORY_FILES
+                }
+                digests = {basename: uuid.uuid4().hex
+                           for basename in leaderboard.CATEGORY_FILES}
+                leaderboard.finish_job(job_id, result, None, digests, versions)
+            except Exception as e:
+                with lock:
+                    errors["write {}".format(type(e).__name__)] += 1
+                continue
+            with lock:
+                n_submitted[0] += 1
+            time.sleep(args.write_interval)
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(n,)) for n in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    leaderboard.score_writer.flush()
+    finished = time.perf_counter()
+
+    results = {"read {}".format(url): summarize(times)
+               for url, times in sorted(read_times.items())}
+    with app.app_context():
+        done = db.session.query(leaderboard.Job).filter_by(status="done").count()
+    # 書き込みは一定時間あたりの件数で見る (エラーは読み込みの分も含めてここに入れる)
+    elapsed = finished - started
+    results["write"] = {"best": elapsed, "mean": elapsed, "repeat": 1,
+                        "submitted": n_submitted[0], "done": done,
+                        "writes_per_sec": done / elapsed, "errors": dict(errors)}
+    # 書き込めなかった提出があれば失敗にする (score_writer で失敗したジョブは failed になる)
+    failures = []
+    if done < n_submitted[0]:
+        failures.append("{} of {} submitted jobs were not written".format(
+            n_submitted[0] - done, n_submitted[0]))
+    # "database is locked" などのエラーも失敗にする
+    if errors:
+        failures.append("errors: {}".format(dict(errors)))
+    results["write"]["failures"] = failures
+    return results
+
+
+def dataset_options(args):
+    return {
+        "n_pages": args.pages,
+        "n_attributes": args.attributes,
+        "attributes_per_page": args.attributes_per_page,
+        "offsets_per_attribute": args.offsets,
+        "overlap": args.overlap,
+        "noise": args.noise,
+        "target_ratio": args.target_ratio,
+        "offset_types": tuple(
+            "{}_offset".format(offset_type) for offset_type in args.offset_types),
+    }
+
+
+def compare(base_path, new_path, threshold):
+    """
+    2つの結果(json)の平均時間を比べ，threshold倍より遅くなったものを返す
+    """
+    with open(base_path) as f:
+        base = json.load(f)["results"]
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    regressions = []
+    for name in base:
+        if name not in new or base[name]["mean"] == 0:
+            continue
+        ratio = new[name]["mean"] / base[name]["mean"]
+        print("{:<28} {:>10.4f}s {:>10.4f}s {:>7.2f}x".format(
+            name, base[name]["mean"], new[name]["mean"], ratio))
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("benchmark",
+                            choices=["decode", "scoring", "app", "sqlite", "compare"])
+    arg_parser.add_argument("results", nargs="*",
+                            help="compare : 比較する2つの結果(json)")
+    arg_parser.add_argument("--lines", type=int, default=200000)
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument("--pages", type=int, default=1000)
+    arg_parser.add_argument("--attributes", type=int, default=30)
+    arg_parser.add_argument("--attributes-per-page", type=int, default=10)
+    arg_parser.add_argument("--offsets", type=int, default=3,
+                            help="属性1つあたりのオフセットの最大数")
+    arg_parser.add_argument("--overlap", type=float, default=0.6)
+    arg_parser.add_argument("--noise", type=float, default=0.3)
+    arg_parser.add_argument("--target-ratio", type=float, default=0.5)
+    arg_parser.add_argument("--offset-types", nargs="+", default=["html", "text"],
+                            choices=["html", "text"])
+    arg_parser.add_argument("--users", type=int, default=10)
+    arg_parser.add_argument("--uploads", type=int, default=2,
+                            help="app : 1人あたりの提出回数")
+    arg_parser.add_argument("--readers", type=int, default=8,
+                            help="sqlite : 読み込みを続けるスレッド数")
+    arg_parser.add_argument("--writers", type=int, default=4,
+                            help="sqlite : 採点結果を書き込むスレッド数")
+    arg_parser.add_argument("--write-interval", type=float, default=0.0,
+                            help="sqlite : 書き込みの間隔(秒)")
+    arg_parser.add_argument("--duration", type=float, default=10.0,
+                            help="sqlite : 計測する秒数")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--threshold", type=float, default=1.2,
+                            help="compare : これより遅くなったら終了コード1")
+    arg_parser.add_argument("--output", help="結果(json)の出力先")
+    args = arg_parser.parse_args()
+
+    if args.benchmark == "decode":
+        results = bench_decode(generate_lines(args.lines), args.repeat)
+        for name, lines_per_sec in results.items():
+            print("{:<24} {:>12,.0f} lines/s".format(name, lines_per_sec))
+        sys.exit(0)
+    if args.benchmark == "compare":
+        if len(args.results) != 2:
+            arg_parser.error("compare には結果のjsonを2つ指定してください")
+        sys.exit(1 if compare(*args.results, args.threshold) else 0)
+
+    work_dir = tempfile.mkdtemp(prefix="leaderboard-benchmark-")
+    try:
+        if args.benchmark == "scoring":
+            results = bench_scoring(generate_dataset(**dict(
+                dataset_options(args), seed=args.seed)), work_dir, args.repeat)
+        elif args.benchmark == "sqlite":
+            results = bench_sqlite(args, work_dir)
+        else:
+            results = bench_app(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        "benchmark": args.benchmark,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "params": {key: value for key, value in vars(args).items()
+                   if key not in ("benchmark", "results", "output")},
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "orjson": scoring.orjson is not None,
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    for name, result in results.items():
+        print("{:<28} best {:>9.4f}s  mean {:>9.4f}s".format(
+            name, result["best"], result["mean"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+    failures = ["{}: {}".format(name, failure)
+                for name, result in results.items()
+                for failure in result.get("failures", [])]
+    for failure in failures:
+        print("FAILED " + failure)
+    sys.exit(1 if failures else 0)
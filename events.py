@@ -0,0 +1,89 @@
+"""
+リーダーボードの更新を Server-Sent Events で接続中のブラウザに配信します。
+(配信はプロセスごと)
+"""
+import itertools
+import json
+import queue
+import threading
+
+
+def format_event(event_id, name, data):
+    """
+    Server-Sent Events の1件分のテキスト
+    """
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        event_id, name, json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+
+
+class Subscriber(object):
+    def __init__(self, max_queue):
+        self.queue = queue.Queue(max_queue)
+        # 受け取りが追いつかずに捨てられた場合 (ブラウザは再接続して読み直す)
+        self.dropped = False
+
+
+class Broker(object):
+    """
+    publish したイベントを購読者ごとのキューに配る
+    イベントは1回だけ文字列にし，受け取りが遅れてキューが溢れた購読者は切断する
+    """
+
+    def __init__(self, max_queue=100, max_subscribers=None, keepalive=15.0):
+        """
+        max_queue : 購読者ごとに溜めておくイベントの数
+        max_subscribers : 同時に購読できる数 (None なら無制限)
+        keepalive : イベントがない時にコメントを送る間隔 (秒)
+        """
+        self.max_queue = max_queue
+        self.max_subscribers = max_subscribers
+        self.keepalive = keepalive
+        self.subscribers = set()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.subscribers)
+
+    def subscribe(self):
+        """
+        購読者を追加する (上限に達している場合は None)
+        """
+        with self.lock:
+            if self.max_subscribers is not None and \
+                    len(self.subscribers) >= self.max_subscribers:
+                return None
+            subscriber = Subscriber(self.max_queue)
+            self.subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, name, data):
+        with self.lock:
+            message = format_event(next(self.ids), name, data)
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(message)
+            except queue.Full:
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+
+    def stream(self, subscriber, retry=5000):
+        """
+        subscriber に届いたイベントを順に返すジェネレータ (レスポンスの本文に使う)
+        接続が切れると呼び出し側で GeneratorExit になり，購読をやめる
+        """
+        try:
+            yield 'retry: {}\n\n'.format(retry)
+            while not subscriber.dropped:
+                try:
+                    yield subscriber.queue.get(timeout=self.keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+        finally:
+            self.unsubscribe(subscriber)
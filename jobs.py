@@ -0,0 +1,254 @@
+"""
+提出ファイルの採点ジョブをワーカープロセスで実行します。
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import zipfile
+import zlib
+import scoring
+
+
+def file_digest(zip_path, fname):
+    """
+    zip内のファイルを展開した内容の sha256
+    """
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(zip_path) as existing_zip:
+        with existing_zip.open(fname, 'r') as submit_file:
+            for chunk in iter(lambda: submit_file.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def archive_path(archive_dir, digest):
+    return os.path.join(archive_dir, digest[:2], digest + '.jsonl.gz')
+
+
+def archive_file(zip_path, fname, archive_dir, digest, compresslevel=1):
+    """
+    zip内のファイルを archive_path(archive_dir, digest) に gzip で保存する
+    (同じ内容のファイルは1つだけ保存し，保存済みなら何もしない)
+    digest : file_digest で求めた sha256
+    compresslevel : 採点と並行して行うので速さを優先して低くしておく
+    """
+    path = archive_path(archive_dir, digest)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file, \
+                gzip.GzipFile(fileobj=tmp_file, mode='wb', mtime=0,
+                              compresslevel=compresslevel) as gz_file, \
+                zipfile.ZipFile(zip_path) as existing_zip, \
+                existing_zip.open(fname, 'r') as submit_file:
+            for chunk in iter(lambda: submit_file.read(1 << 20), b''):
+                gz_file.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def pack_counts(counts):
+    """
+    属性名ごとのTP,TPFP,TPFNを {属性名: [TP, TPFP, TPFN]} の json にして zlib で圧縮する
+    """
+    rows = {attribute: [int(count['TP']), int(count['TPFP']), int(count['TPFN'])]
+            for attribute, count in counts.items()}
+    return zlib.compress(json.dumps(
+        rows, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack_counts(data):
+    """
+    pack_counts の逆 (scoring.aggregate にそのまま渡せる形で返す)
+    """
+    rows = json.loads(zlib.decompress(data).decode('utf-8'))
+    return {attribute: {'TP': tp, 'TPFP': tpfp, 'TPFN': tpfn}
+            for attribute, (tp, tpfp, tpfn) in rows.items()}
+
+
+def score_stream(submit_file, annotation_path, target, engine='python',
+                 measure=False, plain_path=None, html_path=None):
+    """
+    1ファイルを採点する(ワーカープロセスで実行)
+    plain_path, html_path を指定するとオフセットがページのテキストと合っているかも確認する
+    戻り値
+      {'f1': リーダーボードに載せるF1, 'offset_type': 'text' or 'html',
+       'score': そのオフセットでの属性ごとのスコア,
+       'counts': そのオフセットでの属性ごとのTP,TPFP,TPFN (pack_counts で圧縮したもの),
+       'timings': 採点の段階ごとの秒数 (measure=True の場合),
+       'offset_errors': オフセットがずれていた件数 (確認した場合),
+       'offset_error_samples': ずれていたものの一部}
+    """
+    timings = {} if measure else None
+    counts = {}
+    # 展開しながら1行ずつ索引に追加する
+    score_dict = scoring.get_score(
+        answer=annotation_path,
+        result=submit_file,
+        target=target,
+        engine=engine,
+        # 森羅LBと同様，'text_offset' が含まれるデータは 'text' での結果を採用
+        offset_type='auto',
+        timings=timings,
+        counts=counts,
+        plain_path=plain_path,
+        html_path=html_path
+    )
+    errors = None
+    if isinstance(score_dict, tuple):
+        score_dict, errors = score_dict
+    offset_type = 'text' if 'text' in score_dict else 'html'
+    result = {
+        'f1': score_dict[offset_type]['micro_ave']['F1'],
+        'offset_type': offset_type,
+        'score': score_dict[offset_type],
+        'counts': pack_counts(counts[offset_type]),
+        'timings': timings,
+    }
+    if errors is not None:
+        # 先頭の行は列名 (そのオフセットのページがなく確認できなかった場合は0件)
+        rows = errors.get(offset_type, [None])
+        result['offset_errors'] = len(rows) - 1
+        result['offset_error_samples'] = rows[1:11]
+    return result
+
+
+def score_file(zip_path, fname, annotation_path, target, engine='python',
+               measure=False, plain_path=None, html_path=None):
+    """
+    zip内の1ファイルを採点する(戻り値は score_stream と同じ)
+    """
+    with zipfile.ZipFile(zip_path) as existing_zip:
+        with existing_zip.open(fname, 'r') as submit_file:
+            return score_stream(submit_file, annotation_path, target,
+                                engine, measure, plain_path, html_path)
+
+
+def score_archived(path, annotation_path, target, engine='python'):
+    """
+    archive_file で保存したファイルを採点する(戻り値は score_stream と同じ)
+    """
+    with gzip.open(path, 'rb') as submit_file:
+        return score_stream(submit_file, annotation_path, target, engine)
+
+
+def load_annotations(annotation_paths):
+    """
+    ワーカープロセスの初期化時に正答データを読み込んでおく
+    """
+    for annotation_path in annotation_paths:
+        scoring.load_gold(annotation_path)
+
+
+class ScoringQueue(object):
+    """
+    採点ジョブのキュー
+    ジョブ内のカテゴリファイルはプロセスプールで並列に採点し，
+    全ファイルの採点が終わったら callback(job_id, result, error, digests) を呼ぶ
+    同時に採点するジョブは max_active 件までで，残りは順番を待つ
+    """
+
+    def __init__(self, max_workers=None, archive_dir=None, max_active=None,
+                 max_waiting=None):
+        """
+        archive_dir : 指定すると提出ファイルを archive_file で保存する(再採点に使う)
+        max_active : 同時に採点するジョブの数 (None なら max_workers, CPU コア数の順に使う)
+        max_waiting : reserve で受け付ける待ちジョブの数 (None なら無制限)
+        """
+        self.pool = ProcessPoolExecutor(max_workers=max_workers)
+        self.max_active = max_active or max_workers or os.cpu_count()
+        self.dispatcher = ThreadPoolExecutor(max_workers=self.max_active)
+        self.max_waiting = max_waiting
+        self.archive_dir = archive_dir
+        # 受け付けてから終わるまでのジョブの数と，そのうち採点中の数
+        self.pending = 0
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        待ちジョブの枠を1つ確保する (空きがなければ False)
+        確保した枠は submit(..., reserved=True) で使うか release で返す
+        """
+        with self.lock:
+            if self.max_waiting is not None and \
+                    self.pending - self.running >= self.max_waiting:
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+
+    def depth(self):
+        """
+        {'running': 採点中のジョブ数, 'waiting': 順番待ちのジョブ数}
+        """
+        with self.lock:
+            return {'running': self.running, 'waiting': self.pending - self.running}
+
+    def submit(self, job_id, tasks, callback, on_start=None, lookup=None,
+               reserved=False):
+        """
+        tasks : {ファイル名: score_file の引数} の辞書 (この順にプールへ投入する)
+        on_start : 採点を始める時に on_start(job_id) を呼ぶ(任意)
+        lookup : 同じ内容のファイルの採点結果を lookup(ファイル名, sha256) で探す(任意)
+                 見つかった場合はそのファイルを採点しない
+        reserved : reserve で確保した枠を使う (False なら空きに関わらず受け付ける)
+        """
+        if not reserved:
+            with self.lock:
+                self.pending += 1
+        return self.dispatcher.submit(
+            self._run, job_id, tasks, callback, on_start, lookup)
+
+    def _run(self, job_id, tasks, callback, on_start, lookup):
+        with self.lock:
+            self.running += 1
+        try:
+            return self._score(job_id, tasks, callback, on_start, lookup)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.pending -= 1
+
+    def _score(self, job_id, tasks, callback, on_start, lookup):
+        if on_start is not None:
+            on_start(job_id)
+        digests = {}
+        result = {}
+        futures = {}
+        try:
+            for basename, args in tasks.items():
+                digests[basename] = file_digest(args[0], args[1])
+                cached = None
+                if lookup is not None:
+                    cached = lookup(basename, digests[basename])
+                if cached is not None:
+                    result[basename] = dict(cached, cached=True)
+                else:
+                    futures[basename] = self.pool.submit(score_file, *args)
+            # 保存は採点をプールに投入してから，採点と並行して行う
+            # (提出ファイルは callback の後に削除されるので，ここで済ませておく)
+            if self.archive_dir is not None:
+                for basename, args in tasks.items():
+                    archive_file(args[0], args[1], self.archive_dir,
+                                 digests[basename])
+            for basename, future in futures.items():
+                result[basename] = dict(future.result(), cached=False)
+        except Exception as e:
+            for future in futures.values():
+                future.cancel()
+            return callback(job_id, None, e, digests)
+        return callback(job_id, result, None, digests)
@@ -0,0 +1,140 @@
+"""
+処理時間などの計測値を集計し，Prometheus のテキスト形式で出力します。
+(集計はプロセスごと)
+"""
+from contextlib import contextmanager
+import bisect
+import threading
+import time
+
+# 秒単位のバケット
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, escape_label(value)) for name, value in labels
+    ) + '}'
+
+
+class Histogram(object):
+    """
+    ラベルの組ごとのヒストグラム
+    """
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # バケットごとの件数 (最後は +Inf), 合計
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][i] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} histogram'.format(self.name),
+        ]
+        with self.lock:
+            values = [(key, list(counts[0]), counts[1])
+                      for key, counts in sorted(self.values.items())]
+        for key, counts, total in values:
+            labels = list(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(labels + [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(
+                self.name, format_labels(labels), cumulative))
+        return lines
+
+
+class Gauge(object):
+    """
+    出力する時に関数を呼んで値を求める計測値
+    """
+
+    def __init__(self, name, documentation, fn):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+
+    def render(self):
+        return [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} gauge'.format(self.name),
+            '{} {}'.format(self.name, self.fn()),
+        ]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, fn):
+        metric = Gauge(name, documentation, fn)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_duration = registry.histogram(
+    'leaderboard_request_duration_seconds',
+    'Time spent handling HTTP requests.',
+    ('route', 'method', 'status'))
+scoring_stage_duration = registry.histogram(
+    'leaderboard_scoring_stage_duration_seconds',
+    'Time spent in each stage of scoring.get_score per category file.',
+    ('category', 'stage'))
+job_duration = registry.histogram(
+    'leaderboard_job_duration_seconds',
+    'Time from starting to finishing a scoring job.',
+    ('status',))
+sql_duration = registry.histogram(
+    'leaderboard_sql_duration_seconds',
+    'Time spent executing SQL statements.',
+    ('statement',),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+             0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
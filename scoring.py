@@ -4,8 +4,21 @@ Original: https://github.com/k141303/shinra_jp_scorer/blob/master/scoring.py
 import json
 import csv
 import argparse
+import mmap
 import os
-from collections import defaultdict
+import sys
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
+import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 #属性名の修正リスト(shinra2020現在)
 REPLACE_LIST = {
@@ -15,6 +28,69 @@ REPLACE_LIST = {
     "1.6.6.0": {"停車場名": "停車場"}  # Facility:Line_Other
 }
 
+#採点で扱うオフセットの種類
+OFFSET_TYPES = ("html_offset", "text_offset")
+
+
+def orjson_loads(line):
+    """
+    orjsonでデコード(orjsonが受け付けない書き方の場合は標準のjsonで読み直す)
+    """
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return json.loads(line)
+
+
+#ワンライナーjsonのデコーダー(get_scoreのdecoder引数)
+JSON_DECODERS = {"json": json.loads}
+if orjson is not None:
+    JSON_DECODERS["orjson"] = orjson_loads
+DEFAULT_DECODER = "orjson" if orjson is not None else "json"
+
+
+def get_decoder(decoder=None):
+    """
+    デコーダーを取得(名前か関数、Noneの場合は使える中で一番速いもの)
+    """
+    if decoder is None:
+        decoder = DEFAULT_DECODER
+    if callable(decoder):
+        return decoder
+    return JSON_DECODERS[decoder]
+
+
+def extract_fields(line):
+    """
+    採点に必要な項目だけを取り出す
+    戻り値
+      (page_id, attribute, ENE, オフセット)
+      オフセットはOFFSET_TYPESの順に(開始行, 開始オフセット, 終了行, 終了オフセット)のタプル(ない場合はNone)
+    """
+    offsets = []
+    for offset_type in OFFSET_TYPES:
+        offset = line.get(offset_type)
+        if offset is not None:
+            start, end = offset["start"], offset["end"]
+            offset = (start["line_id"], start["offset"],
+                      end["line_id"], end["offset"])
+        offsets.append(offset)
+    return str(line["page_id"]), line["attribute"], line.get("ENE"), offsets
+
+
+def decode_lines(lines, decoder=None):
+    """
+    ワンライナーjsonの行(str, bytes)か読み込み済みの辞書のイテレータから、
+    1行ずつextract_fieldsで必要な項目だけを取り出す(空行は読み飛ばす)
+    """
+    loads = get_decoder(decoder)
+    for line in lines:
+        if isinstance(line, (str, bytes)):
+            if not line.strip():
+                continue
+            line = loads(line)
+        yield extract_fields(line)
+
 #アノテーション取得
 
 
@@ -22,6 +98,239 @@ def get_annotation(path):
     with open(path, "r", encoding="utf_8") as f:
         return [json.loads(line) for line in f.readlines()]
 
+#正答データのキャッシュ(プロセス内で共有)
+
+
+_gold_cache = {}
+_gold_lock = threading.Lock()
+
+
+def prepare_gold(answer, decoder=None):
+    """
+    正答データを採点用に整理します。
+    answerは正答のリストでも、ワンライナーjsonの行のイテレータでも可。
+    1回読むだけでeneの特定とオフセットの索引(OffsetIndex)の作成を行います。
+    """
+    index = OffsetIndex()
+    enes = set()
+    for page_id, attribute, ene, offsets in decode_lines(answer, decoder):
+        if ene is not None:
+            enes.add(ene)
+        #eneが決まるまでは属性名を修正せずに登録しておく
+        index.add(page_id, attribute, offsets)
+
+    #1つ以上のENEが含まれる場合、もしくは1つも含まれない場合にエラー(get_eneと同様)
+    if len(enes) != 1:
+        raise Exception("The test data must contain one type of ENE.")
+    ene = list(enes)[0]
+    index.map_attributes(lambda attr: attribute_corrector(ene, attr))
+
+    return gold_dict(ene, index)
+
+
+def gold_dict(ene, index):
+    return {
+        "ene": ene,
+        "attributes": sorted(index.attributes),
+        "index": index,
+        "pages": frozenset(index.pages),
+        "cleaned": {},
+        "targets": {},
+    }
+
+
+def gold_offsets(gold, offset_type):
+    """
+    正答データのタプル化したオフセットを取得(キャッシュ済みならそれを返す)
+    """
+    cleaned = gold["cleaned"].get(offset_type)
+    if cleaned is None:
+        cleaned = gold["index"].to_cleaned(offset_type)
+        gold["cleaned"][offset_type] = cleaned
+    return cleaned
+
+
+def resolve_target(target):
+    """
+    文字列で指定された採点対象(jsonのリストまたはcsvのパス)をリストに変換
+    """
+    if isinstance(target, str):
+        if target[0] == "[":
+            return json.loads(target)
+        return get_target(target)
+    return target
+
+
+def normalize_target(target):
+    """
+    採点対象のpage_idを文字列のfrozensetに変換
+    targetは文字列(jsonのリストまたはcsvのパス)でも可
+    """
+    if isinstance(target, frozenset):
+        return target
+    return frozenset(str(t) for t in resolve_target(target))
+
+
+def target_pages(gold, target):
+    """
+    正答のpage_idのうち採点対象に含まれるもの(targetごとにキャッシュ)
+    targetがNoneの場合は正答の全てのpage_id
+    """
+    if target is None:
+        return gold["pages"]
+    target = normalize_target(target)
+    pages = gold["targets"].get(target)
+    if pages is None:
+        pages = gold["pages"] & target
+        if len(gold["targets"]) >= 8:
+            gold["targets"].clear()
+        gold["targets"][target] = pages
+    return pages
+
+
+#正答データのスナップショット(compile_snapshotで作成)の形式
+SNAPSHOT_FORMAT = "shinra-gold-snapshot"
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_path(path):
+    """
+    正答データ(jsonl)に対応するスナップショットのディレクトリ
+    """
+    return path + ".snapshot"
+
+
+def read_snapshot_meta(path):
+    with open(os.path.join(path, "meta.json"), "r", encoding="utf_8") as f:
+        meta = json.load(f)
+    if meta.get("format") != SNAPSHOT_FORMAT or meta.get("version") != SNAPSHOT_VERSION:
+        raise Exception("Unsupported snapshot: {}".format(path))
+    return meta
+
+
+def compile_snapshot(path, output=None):
+    """
+    正答データ(jsonl)を読み込み、オフセットの索引をNumPyの配列(.npy)として
+    page_id、属性名の一覧(meta.json)と一緒にディレクトリに書き出します。
+    outputを指定しない場合はsnapshot_path(path)に書き出します。
+    """
+    if output is None:
+        output = snapshot_path(path)
+    stat = os.stat(path)
+    with open(path, "r", encoding="utf_8") as f:
+        gold = prepare_gold(f)
+    index = gold["index"]
+
+    #書き終わってから置き換える
+    parent = os.path.dirname(os.path.abspath(output))
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    try:
+        for offset_type in OFFSET_TYPES:
+            np.save(os.path.join(tmp_dir, offset_type + ".npy"),
+                    index.rows(offset_type))
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf_8") as f:
+            json.dump({
+                "format": SNAPSHOT_FORMAT,
+                "version": SNAPSHOT_VERSION,
+                "ene": gold["ene"],
+                "pages": index.pages,
+                "attributes": index.attributes,
+                "source": {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+            }, f, ensure_ascii=False)
+        if os.path.exists(output):
+            shutil.rmtree(output)
+        os.rename(tmp_dir, output)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return output
+
+
+def load_snapshot(path):
+    """
+    スナップショットを読み込む(オフセットの配列はメモリマップするので、
+    複数のプロセスで同じページキャッシュを共有できます)
+    """
+    meta = read_snapshot_meta(path)
+    index = OffsetIndex()
+    index.pages = meta["pages"]
+    index.page_ids = {page_id: i for i, page_id in enumerate(index.pages)}
+    index.attributes = [sys.intern(attribute) for attribute in meta["attributes"]]
+    index.attribute_ids = {attribute: i for i, attribute in enumerate(index.attributes)}
+    index.growable = False
+    for offset_type in OFFSET_TYPES:
+        offsets = np.load(os.path.join(path, offset_type + ".npy"),
+                          mmap_mode="r")
+        index.offsets[offset_type] = offsets.reshape(-1)
+    return gold_dict(meta["ene"], index)
+
+
+def load_gold(path):
+    """
+    正答データを読み込み、採点用に整理したものをキャッシュします。
+    ファイルの更新時刻かサイズが変わった場合は読み込み直します。
+    pathにはスナップショットのディレクトリも指定できます。
+    jsonlに対応する最新のスナップショット(snapshot_path)があればそちらを読み込みます。
+    """
+    snapshot = path if os.path.isdir(path) else None
+    stat = os.stat(os.path.join(path, "meta.json") if snapshot else path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _gold_cache.get(path)
+    if cached is not None and cached["version"] == version:
+        return cached
+    with _gold_lock:
+        #待っている間に他のスレッドが読み込んだ場合はそれを使う
+        cached = _gold_cache.get(path)
+        if cached is not None and cached["version"] == version:
+            return cached
+        if snapshot is None and os.path.isdir(snapshot_path(path)):
+            try:
+                source = read_snapshot_meta(snapshot_path(path))["source"]
+            except Exception:
+                source = None
+            if source == {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}:
+                snapshot = snapshot_path(path)
+        if snapshot is not None:
+            gold = load_snapshot(snapshot)
+        else:
+            with open(path, "r", encoding="utf_8") as f:
+                gold = prepare_gold(f)
+        gold["version"] = version
+        _gold_cache[path] = gold
+        return gold
+
+
+_ene_cache = {}
+
+
+def load_ene(path):
+    """
+    正答データのeneだけを読み込みます(load_goldと違い索引は作りません)。
+    スナップショットのディレクトリの場合はmeta.json、jsonlの場合はeneを含む最初の行から読みます。
+    ファイルの更新時刻かサイズが変わった場合は読み込み直します。
+    """
+    snapshot = path if os.path.isdir(path) else None
+    stat = os.stat(os.path.join(path, "meta.json") if snapshot else path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _ene_cache.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    gold = _gold_cache.get(path)
+    if gold is not None and gold["version"] == version:
+        ene = gold["ene"]
+    elif snapshot is not None:
+        ene = read_snapshot_meta(snapshot)["ene"]
+    else:
+        ene = None
+        with open(path, "r", encoding="utf_8") as f:
+            for _, _, ene, _ in decode_lines(f):
+                if ene is not None:
+                    break
+        if ene is None:
+            raise Exception("The test data must contain one type of ENE.")
+    _ene_cache[path] = (version, ene)
+    return ene
+
 #wikipediaのデータ取得
 
 
@@ -32,6 +341,159 @@ def get_wiki(path, page_id, extension="txt"):
     except FileNotFoundError:
         return None
 
+#ページのテキストを行に分割したもののキャッシュ
+
+CORPUS_FORMAT = "shinra-text-corpus"
+CORPUS_VERSION = 1
+#PageTextsに保持するページ数の既定値
+PAGE_CACHE_SIZE = 4096
+
+
+def corpus_path(path, extension):
+    """
+    ページのディレクトリ(path)に対応するコーパスのディレクトリ
+    """
+    return "{}.{}.corpus".format(path.rstrip(os.sep), extension)
+
+
+def compile_corpus(path, extension="txt", output=None):
+    """
+    ディレクトリ内の<page_id>.<extension>を1つのファイル(text.bin)に連結し、
+    ページごとの最初の行の番号(pages.npy)、行ごとの開始位置(lines.npy)、
+    page_idの一覧(meta.json)と一緒にディレクトリに書き出します。
+    outputを指定しない場合はcorpus_path(path, extension)に書き出します。
+    """
+    if output is None:
+        output = corpus_path(path, extension)
+    suffix = "." + extension
+    page_ids = sorted(name[:-len(suffix)] for name in os.listdir(path)
+                      if name.endswith(suffix))
+
+    parent = os.path.dirname(os.path.abspath(output))
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    try:
+        page_starts = array("q", [0])
+        line_starts = array("q")
+        position = 0
+        with open(os.path.join(tmp_dir, "text.bin"), "wb") as out:
+            for page_id in page_ids:
+                text = get_wiki(path, page_id, extension=extension)
+                for line in text.split("\n"):
+                    data = line.encode("utf_8")
+                    line_starts.append(position)
+                    out.write(data + b"\n")
+                    position += len(data) + 1
+                page_starts.append(len(line_starts))
+        line_starts.append(position)
+        np.save(os.path.join(tmp_dir, "pages.npy"), np.asarray(page_starts, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, "lines.npy"), np.asarray(line_starts, dtype=np.int64))
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf_8") as f:
+            json.dump({
+                "format": CORPUS_FORMAT,
+                "version": CORPUS_VERSION,
+                "extension": extension,
+                "pages": page_ids,
+            }, f, ensure_ascii=False)
+        if os.path.exists(output):
+            shutil.rmtree(output)
+        os.rename(tmp_dir, output)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return output
+
+
+class Corpus(object):
+    """
+    compile_corpusで書き出したコーパス(本文と索引はメモリマップする)
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf_8") as f:
+            meta = json.load(f)
+        if meta.get("format") != CORPUS_FORMAT or meta.get("version") != CORPUS_VERSION:
+            raise Exception("Unsupported corpus: {}".format(path))
+        self.extension = meta["extension"]
+        self.page_ids = {page_id: i for i, page_id in enumerate(meta["pages"])}
+        self.pages = np.load(os.path.join(path, "pages.npy"), mmap_mode="r")
+        self.lines = np.load(os.path.join(path, "lines.npy"), mmap_mode="r")
+        with open(os.path.join(path, "text.bin"), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                self.text = b""
+            else:
+                self.text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def page(self, page_id):
+        """
+        ページの行のリスト(ページがない場合はNone)
+        行ごとの開始位置からページの範囲だけを読み出して分割します。
+        """
+        i = self.page_ids.get(page_id)
+        if i is None:
+            return None
+        first, last = int(self.pages[i]), int(self.pages[i + 1])
+        start, end = int(self.lines[first]), int(self.lines[last]) - 1
+        return self.text[start:end].decode("utf_8").split("\n")
+
+
+class PageTexts(object):
+    """
+    ページのテキストを行に分割したものを(page_id, extension)ごとに最近使った順で
+    max_pages件まで保持するキャッシュ
+    corpusを指定した場合はファイルを読まずにコーパスから行を取り出します。
+    """
+
+    def __init__(self, path, max_pages=PAGE_CACHE_SIZE, corpus=None):
+        self.path = path
+        self.max_pages = max_pages
+        self.corpus = corpus
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, page_id, extension="txt"):
+        """
+        ページの行のリスト(ページがない場合はNone)
+        """
+        key = (page_id, extension)
+        with self.lock:
+            lines = self.cache.get(key)
+            if lines is not None:
+                self.cache.move_to_end(key)
+                return lines
+        if self.corpus is not None and self.corpus.extension == extension:
+            lines = self.corpus.page(page_id)
+        else:
+            text = get_wiki(self.path, page_id, extension=extension)
+            lines = None if text is None else text.split("\n")
+        if lines is None:
+            return None
+        with self.lock:
+            self.cache[key] = lines
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_pages:
+                self.cache.popitem(last=False)
+        return lines
+
+
+_page_texts = {}
+_page_texts_lock = threading.Lock()
+
+
+def page_texts(path, extension="txt"):
+    """
+    ページのディレクトリごとのPageTexts(プロセス内で共有)
+    corpus_path(path, extension)にコーパスがあればそれを使います。
+    """
+    key = (path, extension)
+    with _page_texts_lock:
+        texts = _page_texts.get(key)
+        if texts is None:
+            corpus = None
+            if os.path.isdir(corpus_path(path, extension)):
+                corpus = Corpus(corpus_path(path, extension))
+            texts = _page_texts[key] = PageTexts(path, corpus=corpus)
+        return texts
+
 #targetのリストを取得
 
 
@@ -87,15 +549,21 @@ def get_ene(one_liner_dict):
     return list(enes)[0]
 
 
+#半角英数記号を全角に変換するテーブル
+FULL_WIDTH_TABLE = str.maketrans(
+    {chr(0x0021 + i): chr(0xFF01 + i) for i in range(94)})
+
+
+@lru_cache(maxsize=65536)
 def attribute_corrector(ene, attr):
     """
     バージョン間での属性名の統一(修正)
     eneはカテゴリー特定のために必要
+    (ene, attr)ごとに結果をキャッシュし、同じ属性名は同じ文字列オブジェクトを返す
     """
-    attr = attr.translate(str.maketrans(
-        {chr(0x0021 + i): chr(0xFF01 + i) for i in range(94)}))
+    attr = attr.translate(FULL_WIDTH_TABLE)
     attr = REPLACE_LIST.get(ene, {}).get(attr, attr)
-    return attr
+    return sys.intern(attr)
 
 
 def liner2dict(one_liner_dict, ene):
@@ -145,6 +613,181 @@ def clean(id_dict, offset_type):
     return cleaned
 
 
+class OffsetIndex(object):
+    """
+    page_idと属性名を通し番号に置き換え、オフセットを整数の配列で保持する索引
+    1つのオフセットは (page, attribute, 開始行, 開始オフセット, 終了行, 終了オフセット) の
+    6つの整数としてoffset_typeごとの配列に並べます。
+    vocabularyに別の索引を渡すと番号を共有し、そちらにないpage_idと属性名は登録しません
+    (システム結果の索引を正答の番号で作る場合に使います)。
+    pickleできるので、ワーカープロセスに渡したりファイルに保存したりできます。
+    """
+    __slots__ = ("pages", "page_ids", "attributes", "attribute_ids",
+                 "offsets", "growable")
+
+    def __init__(self, vocabulary=None):
+        if vocabulary is None:
+            self.pages, self.page_ids = [], {}
+            self.attributes, self.attribute_ids = [], {}
+            self.growable = True
+        else:
+            self.pages, self.page_ids = vocabulary.pages, vocabulary.page_ids
+            self.attributes = vocabulary.attributes
+            self.attribute_ids = vocabulary.attribute_ids
+            self.growable = False
+        self.offsets = {offset_type: array("q") for offset_type in OFFSET_TYPES}
+
+    def add_page(self, page_id, attribute):
+        """
+        page_idと属性名を登録して番号を返す(登録できない場合はNone)
+        """
+        page = self.page_ids.get(page_id)
+        attr = self.attribute_ids.get(attribute)
+        if page is None or attr is None:
+            if not self.growable:
+                return None
+            if page is None:
+                page = self.page_ids[page_id] = len(self.pages)
+                self.pages.append(page_id)
+            if attr is None:
+                attr = self.attribute_ids[attribute] = len(self.attributes)
+                self.attributes.append(attribute)
+        return page, attr
+
+    def add(self, page_id, attribute, offsets, offset_types=OFFSET_TYPES):
+        """
+        1行分のオフセット(extract_fieldsで取り出したもの)を登録
+        登録できなかった場合はFalse
+        """
+        ids = self.add_page(page_id, attribute)
+        if ids is None:
+            return False
+        for offset_type, offset in zip(OFFSET_TYPES, offsets):
+            if offset is not None and offset_type in offset_types:
+                self.offsets[offset_type].extend(ids + offset)
+        return True
+
+    def map_attributes(self, fn):
+        """
+        属性名をfnで変換し、同じ名前になったものは同じ番号にまとめる
+        """
+        attributes, attribute_ids, remap = [], {}, []
+        for attribute in self.attributes:
+            attribute = fn(attribute)
+            attr = attribute_ids.get(attribute)
+            if attr is None:
+                attr = attribute_ids[attribute] = len(attributes)
+                attributes.append(attribute)
+            remap.append(attr)
+        for offset_type, offsets in self.offsets.items():
+            for i in range(1, len(offsets), 6):
+                offsets[i] = remap[offsets[i]]
+        self.attributes, self.attribute_ids = attributes, attribute_ids
+
+    def rows(self, offset_type):
+        """
+        オフセットを(件数, 6)のNumPy配列として返す(コピーしない)
+        """
+        offsets = self.offsets[offset_type]
+        if isinstance(offsets, np.ndarray):
+            #スナップショットから読み込んだ場合
+            return offsets.reshape(-1, 6)
+        return np.frombuffer(offsets, dtype=np.int64).reshape(-1, 6)
+
+    def to_cleaned(self, offset_type):
+        """
+        cleanの戻り値と同じ形の辞書に変換
+        """
+        cleaned = defaultdict(lambda: defaultdict(lambda: []))
+        offsets = self.offsets[offset_type].tolist()
+        for i in range(0, len(offsets), 6):
+            cleaned[self.pages[offsets[i]]][self.attributes[offsets[i + 1]]].append(
+                tuple(offsets[i + 2:i + 6]))
+        return cleaned
+
+
+def index_result(lines, ene, vocabulary=None, pages=None,
+                 offset_types=OFFSET_TYPES, decoder=None, timings=None):
+    """
+    システム結果を1行ずつ読みながらOffsetIndexを作ります。
+    linesはワンライナーjsonの行(str, bytes)のイテレータでも、読み込み済みの辞書のリストでも可。
+    行全体は保持しないので、メモリ使用量は索引の大きさで抑えられます。
+    vocabularyに正答の索引を渡すと、正答にないpage_idと属性名の行は索引に入れません。
+    pagesを指定した場合はそれに含まれるpage_idの行だけを索引に入れます。
+    offset_typesに含まれない種類のオフセットは有無だけを調べます。
+    offset_typesが"auto"の場合は最初の行で決めます(text_offsetがあればtext_offset、なければhtml_offset)。
+    (一部の行にしかオフセットがない場合はエラーになるので、最初の行で決めて問題ない)
+    timingsに辞書を渡すと、デコード("decode")、属性名の統一("normalize")、
+    索引への追加("index")にかかった秒数を加えます(計測の分だけ遅くなります)。
+    戻り値
+      index : OffsetIndex
+      html, plain : HTML、プレーンテキストのオフセットを保持しているかのフラグ
+    """
+    index = OffsetIndex(vocabulary)
+    n_html, n_plain = 0, 0
+    n_lines = 0
+    #計測しない場合は時刻を取らない
+    clock = time.perf_counter if timings is not None else no_clock
+    decode, normalize, add = 0.0, 0.0, 0.0
+    decoded = iter(decode_lines(lines, decoder))
+    while True:
+        t0 = clock()
+        try:
+            page_id, attribute, _, offsets = next(decoded)
+        except StopIteration:
+            decode += clock() - t0
+            break
+        t1 = clock()
+        decode += t1 - t0
+        if offset_types == "auto":
+            offset_types = auto_offset_types(offsets)
+        n_lines += 1
+        if offsets[0] is not None:
+            n_html += 1
+        if offsets[1] is not None:
+            n_plain += 1
+        #採点対象でない場合はオフセットの有無だけ数える
+        if pages is None or page_id in pages:
+            attribute = attribute_corrector(ene, attribute)
+            t2 = clock()
+            normalize += t2 - t1
+            index.add(page_id, attribute, offsets, offset_types)
+            add += clock() - t2
+    if timings is not None:
+        for stage, elapsed in (("decode", decode), ("normalize", normalize), ("index", add)):
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+    return index_flags(index, n_lines, n_html, n_plain)
+
+
+def no_clock():
+    """
+    計測しない場合にtime.perf_counterの代わりに使う
+    """
+    return 0.0
+
+
+def auto_offset_types(offsets):
+    """
+    offset_type="auto"で索引を作るオフセットの種類(1行分のオフセットから決める)
+    """
+    return ("text_offset",) if offsets[1] is not None else ("html_offset",)
+
+
+def index_flags(index, n_lines, n_html, n_plain):
+    """
+    行数とオフセットを持つ行数から、HTML、プレーンテキストのフラグを求める
+    """
+    n_offsets = {"html_offset": n_html, "text_offset": n_plain}
+
+    #一部の行にしかオフセットがない場合はエラー(cleanと同様)
+    for offset_type, count in n_offsets.items():
+        if 0 < count < n_lines:
+            raise Exception(
+                "All lines must contain {} if any line does.".format(offset_type))
+
+    return index, n_offsets["html_offset"] > 0, n_offsets["text_offset"] > 0
+
+
 def calc_score(count):
     """
     TP, FP, FNから再現率、精度、F値を計算
@@ -201,13 +844,27 @@ def scoring(answer, result, target, attributes, offset_type):
     #採点のため答えと採点対象を簡略化
     answer = clean(answer, offset_type)
     result = clean(result, offset_type)
+    target = normalize_target(target)
+    pages = [page_id for page_id in answer if page_id in target]
+    return scoring_cleaned(answer, result, pages, attributes)
 
+
+def scoring_cleaned(answer, result, pages, attributes):
+    """
+    完全一致でスコアを計算(clean済みの答えと採点対象を受け取る)
+    pagesは採点対象に含まれる正答のpage_id(target_pagesで求めたもの)
+    """
+    return aggregate(counting_cleaned(answer, result, pages, attributes))
+
+
+def counting_cleaned(answer, result, pages, attributes):
+    """
+    属性名ごとにTP,TPFP,TPFNを数える(clean済みの答えと採点対象を受け取る)
+    """
     #TP,FP,FNをカウント
     counter = defaultdict(lambda: {"TP": 0, "TPFP": 0, "TPFN": 0})
-    for page_id, item in answer.items():
-        if page_id not in target:
-            #対象でない場合はスキップ
-            continue
+    for page_id in pages:
+        item = answer.get(page_id, {})
         for attribute in attributes:
             if result.get(page_id) is None or result[page_id].get(attribute) is None:
                 res = []
@@ -220,7 +877,13 @@ def scoring(answer, result, target, attributes, offset_type):
             counter[attribute]["TP"] += len(set(ans) & set(res))
             counter[attribute]["TPFP"] += len(set(res))
             counter[attribute]["TPFN"] += len(set(ans))
+    return counter
+
 
+def aggregate(counter):
+    """
+    属性名ごとのTP,TPFP,TPFNからスコアを計算
+    """
     #再現率、精度、F値を計算
     score = {attribute: calc_score(count)
              for attribute, count in counter.items()}
@@ -234,15 +897,130 @@ def scoring(answer, result, target, attributes, offset_type):
     return score
 
 
+def scoring_python(gold, result, offset_type, pages):
+    """
+    正答(prepare_goldの戻り値)とシステム結果の索引からscoring_cleanedでスコアを計算
+    """
+    return aggregate(counting_python(gold, result, offset_type, pages))
+
+
+def counting_python(gold, result, offset_type, pages):
+    """
+    属性名ごとにTP,TPFP,TPFNを数える(counting_cleanedを使う)
+    """
+    return counting_cleaned(gold_offsets(gold, offset_type),
+                            result.to_cleaned(offset_type),
+                            pages, gold["attributes"])
+
+
+def pack_rows(*arrays):
+    """
+    encode_offsetsの配列の各行を1つの整数にまとめる(行の大小関係は保たれる)
+    int64に収まらない場合はNoneを返す
+    """
+    stacked = np.concatenate(arrays)
+    if len(stacked) == 0:
+        return [np.zeros(len(a), dtype=np.int64) for a in arrays], [0] * 6, [1] * 6
+    low = stacked.min(axis=0)
+    radix = [int(r) for r in stacked.max(axis=0) - low + 1]
+    if np.prod(radix, dtype=float) >= 2 ** 63:
+        return None
+    packed = []
+    for rows in arrays:
+        key = np.zeros(len(rows), dtype=np.int64)
+        for col, r in enumerate(radix):
+            key = key * r + (rows[:, col] - low[col])
+        packed.append(key)
+    return packed, low, radix
+
+
+def scoring_numpy(gold, result, offset_type, pages):
+    """
+    完全一致でスコアを計算(scoring_pythonと同じ結果をNumPyの配列演算で求める)
+    resultはgold["index"]と番号を共有する索引(index_resultでvocabularyを指定したもの)
+    """
+    return aggregate(counting_numpy(gold, result, offset_type, pages))
+
+
+def counting_numpy(gold, result, offset_type, pages):
+    """
+    属性名ごとにTP,TPFP,TPFNを数える(counting_pythonと同じ結果をNumPyの配列演算で求める)
+    """
+    answer = gold["index"]
+    attributes = gold["attributes"]
+
+    #TP,FP,FNをカウント
+    counter = {}
+    if pages:
+        #採点対象のページの行だけを残す
+        page_ids = np.fromiter((answer.page_ids[page_id] for page_id in pages),
+                               dtype=np.int64, count=len(pages))
+        ans = answer.rows(offset_type)
+        res = result.rows(offset_type)
+        ans = ans[np.isin(ans[:, 0], page_ids)]
+        res = res[np.isin(res[:, 0], page_ids)]
+        packed = pack_rows(ans, res)
+        if packed is not None:
+            #1つの整数にまとめて重複を除き、両方に含まれるものをTPとする
+            (ans, res), low, radix = packed
+            ans, res = np.unique(ans), np.unique(res)
+            tp = np.intersect1d(ans, res, assume_unique=True)
+            div = int(np.prod(radix[2:]))
+            ans_attr, res_attr, tp_attr = [
+                (key // div) % radix[1] + low[1] for key in (ans, res, tp)]
+        else:
+            #まとめられない場合は行単位で重複を除く
+            ans = np.unique(ans, axis=0)
+            res = np.unique(res, axis=0)
+            rows, counts = np.unique(np.concatenate([ans, res]), axis=0,
+                                     return_counts=True)
+            ans_attr, res_attr, tp_attr = ans[:, 1], res[:, 1], rows[counts == 2, 1]
+        n = len(answer.attributes)
+        tp = np.bincount(tp_attr, minlength=n)
+        tpfp = np.bincount(res_attr, minlength=n)
+        tpfn = np.bincount(ans_attr, minlength=n)
+        for attribute in attributes:
+            i = answer.attribute_ids[attribute]
+            counter[attribute] = {"TP": int(tp[i]),
+                                  "TPFP": int(tpfp[i]),
+                                  "TPFN": int(tpfn[i])}
+    return counter
+
+
+#採点方法(get_scoreのengine引数)
+SCORING_ENGINES = {
+    "python": scoring_python,
+    "numpy": scoring_numpy,
+}
+
+#採点方法ごとのTP,TPFP,TPFNの数え方
+COUNTING_ENGINES = {
+    "python": counting_python,
+    "numpy": counting_numpy,
+}
+
+
 def diff(text, offsets, offset_type):
     """
     オフセット(リスト)からテキストを取得
     抽出されたテキストと保持しているテキストを比較
     違う場合はエラーログで返す
+    textは行に分割済みのリスト(PageTexts.getの戻り値)でも可
     """
-    splitext = text.split("\n")
+    splitext = text.split("\n") if isinstance(text, str) else text
     error = []
     for offset in offsets:
+        #ページの行数を超える行を指すオフセットは比較できないので、そのままエラーにする
+        if offset[offset_type]["start"]["line_id"] < 0 or \
+                offset[offset_type]["end"]["line_id"] >= len(splitext):
+            error.append([offset["page_id"], "Out of range", offset["title"],
+                          offset[offset_type]["start"]["line_id"],
+                          offset[offset_type]["start"]["offset"],
+                          offset[offset_type]["end"]["line_id"],
+                          offset[offset_type]["end"]["offset"],
+                          offset[offset_type]["text"],
+                          ""])
+            continue
         accum = ""
         for idx, line_id in enumerate(range(offset[offset_type]["start"]["line_id"], offset[offset_type]["end"]["line_id"]+1)):
             sol, eol = 0, len(splitext[line_id])
@@ -264,14 +1042,17 @@ def diff(text, offsets, offset_type):
     return error
 
 
-def checker(path, result, extension="txt"):
+def checker(path, result, extension="txt", texts=None):
     """
     オフセットとテキストのズレを確認
+    ページのテキストはtexts(PageTexts、省略時はpage_texts(path, extension))から取得します。
     """
+    if texts is None:
+        texts = page_texts(path, extension)
     error = [["page_id", "error_type", "title", "start_lineid",
               "start_offset", "end_lineid", "end_offset", "text", "extracted_string"]]
     for page_id, item in result.items():
-        text = get_wiki(path, page_id, extension=extension)
+        text = texts.get(page_id, extension)
         if text is None:
             error.append([page_id, "Not Found"])
             continue
@@ -296,20 +1077,45 @@ def print_score(score):
                                                      item_["F1"]))
 
 
-def get_score(answer, result, target=None, html_path=None, plain_path=None, error_path=None, score_path=None):
+def evaluate(counting_fn, gold, result_index, offset_type, pages, timings, counts, name):
+    """
+    get_scoreで1種類のオフセットを採点する(必要なら秒数とTP,TPFP,TPFNを記録する)
+    """
+    started = time.perf_counter()
+    counter = counting_fn(gold, result_index, offset_type, pages)
+    compared = time.perf_counter()
+    score = aggregate(counter)
+    if timings is not None:
+        timings["compare"] = timings.get("compare", 0.0) + compared - started
+        timings["aggregate"] = timings.get("aggregate", 0.0) + \
+            time.perf_counter() - compared
+    if counts is not None:
+        counts[name] = dict(counter)
+    return score
+
+
+def get_score(answer, result, target=None, html_path=None, plain_path=None, error_path=None, score_path=None, engine="python", offset_type=None, decoder=None, timings=None, counts=None):
     """
     スコアを計算します。
     引数
       answer, result ,target(任意) ,html_path(任意) ,plain_path(任意)
         answer : 正答のリスト(ワンライナーjsonをリストとして読み込んだものと等価)
-                 pathでも可
+                 pathでも可(pathの場合は読み込んだ結果をキャッシュして再利用します)
         result : システム結果のリスト
-                 pathでも可
+                 pathでも可、ワンライナーjsonの行のイテレータ(zip内のファイルオブジェクトなど)でも可
         target : 採点の対象とするpage_idのリスト(入力しない場合はresultに含まれるpage_idが対象になります。)
         html_path : HTMLファイルの場所(入力するとオフセットが合っているかを確認します)
         plain_path : プレーンテキストファイルの場所(同上)
         error_path : エラーログを指定したpathに書き出します。(任意)
         score_path : スコアログを指定したpathに書き出します。(任意)
+        engine : 採点方法 "python" または "numpy"(任意、結果は同じ)
+        offset_type : 採点するオフセットの種類(任意、入力しない場合は含まれるもの全て)
+                      "html", "text" または "auto"(text_offsetを含む場合は"text"、含まない場合は"html")
+        decoder : システム結果のデコーダー "json", "orjson" または関数(任意、入力しない場合は使える中で一番速いもの)
+        timings : 辞書を渡すと段階ごとにかかった秒数を格納します(任意)
+                  "gold", "decode", "normalize", "index", "compare", "aggregate"
+        counts : 辞書を渡すと属性名ごとのTP,TPFP,TPFNを
+                 html、プレーンでそれぞれ格納します(任意)
     戻り値
       score
         score : スコア(html、プレーンでそれぞれのスコア格納した辞書)
@@ -319,31 +1125,57 @@ def get_score(answer, result, target=None, html_path=None, plain_path=None, erro
         error : オフセットが間違っていた場合のエラー(html、プレーンでそれぞれのエラーを格納した辞書)
     """
     #正答とシステム結果の取得(answer,resultがファイルパスの場合)
+    started = time.perf_counter()
     if isinstance(answer, str):
-        answer = get_annotation(answer)
-    if isinstance(result, str):
-        result = get_annotation(result)
-    if isinstance(target, str):
-        if target[0] == "[":
-            target = json_loads(target)
-        else:
-            target = get_target(target)
+        gold = load_gold(answer)
+    else:
+        gold = prepare_gold(answer, decoder)
+    if timings is not None:
+        timings["gold"] = time.perf_counter() - started
+    target = resolve_target(target)
 
-        target = [str(t) for t in target]
+    counting_fn = COUNTING_ENGINES[engine]
 
     #正答データのeneを取得
-    ene = get_ene(answer)
+    ene = gold["ene"]
+
+    #採点対象のpage_idを取得(正答に含まれるものだけを残す)
+    n_target = len(gold["pages"]) if target is None else len(target)
+    pages = target_pages(gold, target)
+
+    #索引を作るオフセットの種類("auto"の場合はindex_resultで最初の行から決める)
+    offset_types = {"html": ("html_offset",), "text": ("text_offset",),
+                    "auto": "auto"}.get(offset_type, OFFSET_TYPES)
 
     #辞書形式に変換(+属性名の統一・修正)
-    answer, _, _, attributes = liner2dict(answer, ene)
-    result, html_flag, plain_flag, _ = liner2dict(result, ene)
+    if html_path is not None or plain_path is not None:
+        #オフセットを確認する場合は行全体が必要になるので読み込んでおく
+        if isinstance(result, str):
+            result = get_annotation(result)
+        else:
+            result = [json.loads(line) if isinstance(line, (str, bytes)) else line
+                      for line in result]
+        result_index, html_flag, plain_flag = index_result(
+            result, ene, gold["index"], pages, offset_types, decoder, timings)
+        result, _, _, _ = liner2dict(result, ene)
+    elif isinstance(result, str):
+        with open(result, "r", encoding="utf_8") as f:
+            result_index, html_flag, plain_flag = index_result(
+                f, ene, gold["index"], pages, offset_types, decoder, timings)
+    else:
+        result_index, html_flag, plain_flag = index_result(
+            result, ene, gold["index"], pages, offset_types, decoder, timings)
 
-    #採点対象のpage_idを取得
-    if target is None:
-        target = list(answer.keys())
+    #指定された種類のオフセットだけを採点する
+    if offset_type == "auto":
+        offset_type = "text" if plain_flag else "html"
+    if offset_type == "html":
+        plain_flag = False
+    elif offset_type == "text":
+        html_flag = False
 
     if __name__ == "__main__":
-        print("Number of scoring targets : {}".format(len(target)))
+        print("Number of scoring targets : {}".format(n_target))
         print("Target : {}".format(("HTML" if html_flag else "")
                                    + (" & " if html_flag & plain_flag else "")
                                    + ("PLAIN" if plain_flag else "")))
@@ -352,8 +1184,8 @@ def get_score(answer, result, target=None, html_path=None, plain_path=None, erro
     error = {}
     if html_flag:
         #スコアの計算
-        score["html"] = scoring(answer, result, target,
-                                attributes, "html_offset")
+        score["html"] = evaluate(counting_fn, gold, result_index, "html_offset",
+                                pages, timings, counts, "html")
         if html_path is not None:
             #オフセットが合っているか確認
             error["html"] = checker(html_path, result, "html")
@@ -362,8 +1194,8 @@ def get_score(answer, result, target=None, html_path=None, plain_path=None, erro
 
     if plain_flag:
         #スコアの計算
-        score["text"] = scoring(answer, result, target,
-                                attributes, "text_offset")
+        score["text"] = evaluate(counting_fn, gold, result_index, "text_offset",
+                                pages, timings, counts, "text")
         if plain_path is not None:
             #オフセットが合っているか確認
             error["text"] = checker(plain_path, result, "txt")
@@ -385,3 +1217,30 @@ def get_score(answer, result, target=None, html_path=None, plain_path=None, erro
         out_csv(error_path, error, "error_log")
 
     return score, error
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    subparsers = arg_parser.add_subparsers(dest="command")
+    compile_parser = subparsers.add_parser(
+        "compile", help="正答データ(jsonl)をスナップショットに変換")
+    compile_parser.add_argument("annotation", help="正答データのpath")
+    compile_parser.add_argument(
+        "-o", "--output", help="書き出し先(省略時は<annotation>.snapshot)")
+    corpus_parser = subparsers.add_parser(
+        "compile-corpus", help="ページのテキスト(HTML)のディレクトリをコーパスに変換")
+    corpus_parser.add_argument("path", help="ページのディレクトリ")
+    corpus_parser.add_argument(
+        "-e", "--extension", default="txt", help="ページの拡張子(txt or html)")
+    corpus_parser.add_argument(
+        "-o", "--output", help="書き出し先(省略時は<path>.<extension>.corpus)")
+    args = arg_parser.parse_args()
+
+    if args.command == "compile":
+        output = compile_snapshot(args.annotation, args.output)
+        print("Snapshot : {}".format(output))
+    elif args.command == "compile-corpus":
+        output = compile_corpus(args.path, args.extension, args.output)
+        print("Corpus : {}".format(output))
+    else:
+        arg_parser.print_help()
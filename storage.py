@@ -0,0 +1,175 @@
+"""
+SQLite を複数のスレッドから使うための設定と，
+書き込みを1つのスレッドにまとめて commit する BatchWriter，
+問い合わせ結果を保持する TTLCache
+"""
+from collections import OrderedDict
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+# 接続ごとに設定する PRAGMA
+# WAL にすると書き込み中も読み込みが待たされない
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 10000),
+    ('cache_size', -16000),
+    ('temp_store', 'MEMORY'),
+)
+
+
+def is_sqlite_file(uri):
+    return uri.startswith('sqlite:///') and ':memory:' not in uri
+
+
+def sqlite_engine_options(pool_size=10, max_overflow=10, timeout=10):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS (マルチスレッドのサーバ向けに接続を使い回す)
+    """
+    return {
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': timeout,
+        'connect_args': {'check_same_thread': False, 'timeout': timeout},
+    }
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # Engine の connect イベントで呼ぶ
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS:
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+
+class BatchWriter(object):
+    """
+    書き込みを1つのスレッドで順に行う
+    put した値をまとめて write_batch(values) に渡す (write_batch の中で commit する)
+    write_batch が失敗した場合は1件ずつ渡し直し，それでも失敗した値は
+    on_failure(value, error) に渡して諦める (別のトランザクションで失敗を記録するのに使う)
+    書き込めた値は write_batch の戻り値と一緒に after_write(values, written) に渡す
+    (commit の後の処理はここで行い，失敗しても書き込みをやり直さないようにする)
+    """
+
+    def __init__(self, write_batch, max_batch=50, name='batch-writer', on_failure=None,
+                 after_write=None):
+        self.write_batch = write_batch
+        self.on_failure = on_failure
+        self.after_write = after_write
+        self.max_batch = max_batch
+        self.name = name
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, value):
+        self.start()
+        self.queue.put(value)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def flush(self):
+        """
+        それまでに put した値の書き込みが終わるまで待つ
+        """
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        try:
+            written = self.write_batch(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self._fail(batch[0], e)
+                return
+            logger.warning('%s: batch of %d failed, retrying one by one',
+                           self.name, len(batch))
+        else:
+            self._after(batch, written)
+            return
+        for value in batch:
+            try:
+                written = self.write_batch([value])
+            except Exception as e:
+                self._fail(value, e)
+            else:
+                self._after([value], written)
+
+    def _after(self, values, written):
+        if self.after_write is None:
+            return
+        try:
+            self.after_write(values, written)
+        except Exception:
+            logger.exception('%s: after_write failed', self.name)
+
+    def _fail(self, value, error):
+        logger.error('%s: write failed', self.name, exc_info=error)
+        if self.on_failure is None:
+            return
+        try:
+            self.on_failure(value, error)
+        except Exception:
+            logger.exception('%s: on_failure failed', self.name)
+
+
+class TTLCache(object):
+    """
+    最近使った順に max_size 件まで，それぞれ ttl 秒間値を保持するキャッシュ
+    """
+
+    def __init__(self, max_size=1024, ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.values.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self.values[key]
+                return None
+            self.values.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = (time.monotonic() + self.ttl, value)
+            self.values.move_to_end(key)
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
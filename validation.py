@@ -0,0 +1,143 @@
+"""
+提出ファイル(zip)を採点の前に検査します。
+1行ずつ読みながら検査し，エラーが max_errors 件見つかった時点で打ち切ります。
+"""
+import os
+import zipfile
+import scoring
+
+
+def error(message, fname=None, line=None):
+    return {'file': fname, 'line': line, 'message': message}
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def check_offset(offset, offset_type):
+    """
+    オフセットの形式を検査し，エラーの内容を返す(問題がなければNone)
+    """
+    if not isinstance(offset, dict):
+        return '{} がオブジェクトではありません'.format(offset_type)
+    for position in ('start', 'end'):
+        point = offset.get(position)
+        if not isinstance(point, dict):
+            return '{}.{} がありません'.format(offset_type, position)
+        for key in ('line_id', 'offset'):
+            if not is_int(point.get(key)):
+                return '{}.{}.{} が整数ではありません'.format(offset_type, position, key)
+    return None
+
+
+def validate_lines(lines, fname, ene, target=None, strict_target=False,
+                   max_errors=20, decoder=None):
+    """
+    ワンライナーjsonの行を検査し，エラーのリストを返す
+      ene : 正答データのENE (提出データのENEと一致する必要がある)
+      target : 採点対象の page_id の集合 (1行も含まれない場合はエラー)
+      strict_target : Trueの場合は target に含まれない page_id の行をエラーにする
+    """
+    loads = scoring.get_decoder(decoder)
+    errors = []
+    n_lines = 0
+    n_target = 0
+    # オフセットの種類ごとに，それを含む行の数と最初に含まなかった行
+    n_offsets = {offset_type: 0 for offset_type in scoring.OFFSET_TYPES}
+    first_missing = {}
+    for line_no, line in enumerate(lines, 1):
+        if len(errors) >= max_errors:
+            break
+        if not line.strip():
+            continue
+        try:
+            item = loads(line)
+        except ValueError:
+            errors.append(error('jsonとして読み込めません', fname, line_no))
+            continue
+        if not isinstance(item, dict):
+            errors.append(error('jsonのオブジェクトではありません', fname, line_no))
+            continue
+        n_lines += 1
+
+        page_id = item.get('page_id')
+        if not isinstance(page_id, str) and not is_int(page_id):
+            errors.append(error('page_id がありません', fname, line_no))
+        elif target is not None and str(page_id) in target:
+            n_target += 1
+        elif strict_target and target is not None:
+            errors.append(error(
+                'page_id {} は採点対象ではありません'.format(page_id), fname, line_no))
+        if not isinstance(item.get('attribute'), str):
+            errors.append(error('attribute がありません', fname, line_no))
+        if item.get('ENE') is not None and item['ENE'] != ene:
+            errors.append(error('ENE が {} ではありません ({})'.format(
+                ene, item['ENE']), fname, line_no))
+
+        has_offset = False
+        for offset_type in scoring.OFFSET_TYPES:
+            offset = item.get(offset_type)
+            if offset is None:
+                first_missing.setdefault(offset_type, line_no)
+                continue
+            has_offset = True
+            n_offsets[offset_type] += 1
+            message = check_offset(offset, offset_type)
+            if message is not None:
+                errors.append(error(message, fname, line_no))
+        if not has_offset:
+            errors.append(error('html_offset と text_offset のどちらもありません',
+                                fname, line_no))
+
+    if len(errors) < max_errors:
+        if n_lines == 0:
+            errors.append(error('データがありません', fname))
+        elif target is not None and n_target == 0:
+            errors.append(error('採点対象の page_id が1つもありません', fname))
+        # 一部の行にしかオフセットがない場合は採点できない
+        for offset_type, count in n_offsets.items():
+            if 0 < count < n_lines:
+                errors.append(error(
+                    '{} が一部の行にしかありません'.format(offset_type),
+                    fname, first_missing[offset_type]))
+    return errors[:max_errors]
+
+
+def validate_submission(zip_file, enes, targets=None, strict_target=False,
+                        max_errors=20, decoder=None):
+    """
+    提出ファイル(zip)を検査し，エラーのリストを返す
+    エラーは {'file': ファイル名, 'line': 行番号, 'message': 内容} (ファイル構成のエラーは file, line が None)
+      enes : {ファイル名: 正答データのENE} (zip内にこれらのファイルがそれぞれ1つだけ必要)
+      targets : {ファイル名: 採点対象の page_id の集合} (任意)
+      strict_target : Trueの場合は採点対象にない page_id の行もエラーにする
+    """
+    try:
+        existing_zip = zipfile.ZipFile(zip_file)
+    except zipfile.BadZipFile:
+        return [error('zipファイルとして読み込めません')]
+    with existing_zip:
+        members = {}
+        for info in existing_zip.infolist():
+            if info.is_dir():
+                continue
+            members.setdefault(os.path.basename(info.filename), []).append(info.filename)
+        errors = []
+        for basename in sorted(enes):
+            if basename not in members:
+                errors.append(error('{} がありません'.format(basename)))
+            elif len(members[basename]) > 1:
+                errors.append(error('{} が複数あります'.format(basename)))
+        if errors:
+            return errors
+        for basename in sorted(enes):
+            fname = members[basename][0]
+            with existing_zip.open(fname, 'r') as submit_file:
+                errors.extend(validate_lines(
+                    submit_file, fname, enes[basename],
+                    None if targets is None else targets[basename],
+                    strict_target, max_errors - len(errors), decoder))
+            if len(errors) >= max_errors:
+                break
+    return errors